@@ -1,12 +1,35 @@
 """Init."""
 
-from . import crypt, databases, index, schemes, tokens, utils
+from . import (
+    bench,
+    cache,
+    crypt,
+    databases,
+    entries,
+    index,
+    query,
+    schemes,
+    state,
+    static,
+    storage,
+    tdp,
+    tokens,
+    utils,
+)
 
 __all__ = [
+    "bench",
+    "cache",
     "crypt",
     "databases",
+    "entries",
     "index",
+    "query",
     "schemes",
+    "state",
+    "static",
+    "storage",
+    "tdp",
     "tokens",
     "utils",
 ]
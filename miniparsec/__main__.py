@@ -1,19 +1,87 @@
 import argparse
+import asyncio
+from collections.abc import Callable, Coroutine
+from functools import wraps
 from pathlib import Path
+from typing import Any
 
-from miniparsec import databases, index, schemes
-from miniparsec.paths import CLIENT_ROOT
-from miniparsec.utils import console, datasets, timing, watcher
+from psycopg_pool import ConnectionPool
 
+from miniparsec import bench, databases, index, schemes
+from miniparsec.paths import CLIENT_ROOT, LOCK_PATH
+from miniparsec.storage import (
+    PostgresStorage,
+    SQLiteStorage,
+    StaticStorage,
+    Storage,
+)
+from miniparsec.utils import console, datasets, file, timing, watcher
+
+from .cache import SearchCache
 from .crypt import hmac
 
 
+def run_async(
+    scheme: schemes.Scheme, function: Callable[..., Coroutine], max_size: int
+) -> Callable:
+    """Version synchrone d'une méthode asynchrone, avec un pool pour l'appel."""
+
+    @wraps(function)
+    def wrap(*args: Any) -> Any:
+        async def run() -> Any:
+            storage = scheme.storage
+            if isinstance(storage, StaticStorage):
+                # Seules les tables non statiques sont lues par des requêtes
+                storage = storage.base
+            if not isinstance(storage, PostgresStorage):
+                return await function(*args)
+            async with databases.create_async_pool(max_size=max_size) as pool:
+                storage.async_pool = pool
+                try:
+                    return await function(*args)
+                finally:
+                    storage.async_pool = None
+
+        return asyncio.run(run())
+
+    return wrap
+
+
 def main() -> None:
     store = "store_true"
     parser = argparse.ArgumentParser(
         prog="Mini-Parsec",
         description="Mini-Parsec : serveur et recherche.",
     )
+    parser.add_argument(
+        "--pool-min",
+        type=int,
+        help="min pooled connections",
+        default=databases.POOL_MIN_SIZE,
+    )
+    parser.add_argument(
+        "--pool-max",
+        type=int,
+        help="max pooled connections",
+        default=databases.POOL_MAX_SIZE,
+    )
+    parser.add_argument(
+        "--partitions",
+        type=int,
+        help="hash partitions of created tables (0: plain tables)",
+        default=databases.PARTITIONS,
+    )
+    parser.add_argument(
+        "--storage",
+        choices=["postgres", "sqlite", "memory"],
+        help="backend of the encrypted tables (memory: scheme benches only)",
+        default="postgres",
+    )
+    parser.add_argument(
+        "--static",
+        help="serve EDB from a memory-mapped file rebuilt by each merge",
+        action=store,
+    )
     subparsers = parser.add_subparsers(dest="command")
 
     dataset = subparsers.add_parser("dataset", help="Download datasets")
@@ -26,83 +94,157 @@ def main() -> None:
     search.add_argument("-i", "--inter", help="search intersection", action=store)
     search.add_argument("-u", "--union", help="search union", action=store)
     search.add_argument("-s", "--show", help="show results", action=store)
+    search.add_argument("-c", "--cache", help="use the search cache", action=store)
+    search.add_argument("-a", "--aio", help="concurrent async search", action=store)
 
     server = subparsers.add_parser("server", help="Mini-parsec server")
     server.add_argument("-K", "--key", type=str, help="search term", required=True)
     server.add_argument("-r", "--reset", help="reset server", action=store)
+    server.add_argument("-V", "--vocabulary", type=Path, help="stem cache words")
 
     merge = subparsers.add_parser("merge", help="merge or re-encrypt.")
     merge.add_argument("-K", "--key", type=str, help="search term", required=True)
     merge.add_argument("-K2", "--newkey", type=str, help="new key", default=None)
+    merge.add_argument("-m", "--memory", type=int, help="memory ceiling (MB)")
+    merge.add_argument("-w", "--workers", type=int, help="merge processes")
+
+    benchp = subparsers.add_parser("bench", help="run client microbenchmarks")
+    benchp.add_argument(
+        "-t", "--target", choices=["keys", "schemes", "lookup"], default="keys"
+    )
+    benchp.add_argument(
+        "-n", "--count", type=int, help="keys, files or rows", default=None
+    )
+    benchp.add_argument("-C", "--corpus", type=Path, help="files for scheme benches")
 
     indexf = subparsers.add_parser("index", help="show index of a specific clear file.")
     indexf.add_argument("-f", "--file", type=str, help="file path", required=True)
 
     subparsers.required = True
     args = parser.parse_args()
+    pool: ConnectionPool | None = None
 
     if args.command == "dataset":
         datasets.download_gutenberg()
         datasets.download_enron()
         datasets.download_corpora()
         return
+    elif args.command == "bench":
+        if args.target == "keys":
+            bench.bench_keys(args.count or 10_000)
+        elif args.target == "lookup":
+            pool = databases.create_pool(args.pool_min, args.pool_max)
+            bench.bench_lookup(pool, args.count or 10_000_000, args.partitions or 8)
+            pool.close()
+        else:
+            if args.corpus is None:
+                benchp.error("-C/--corpus is required for scheme benches")
+            if args.storage == "postgres":
+                pool = databases.create_pool(args.pool_min, args.pool_max)
+            bench.bench_schemes(
+                args.corpus.resolve(),
+                args.count or 200,
+                args.storage,
+                args.static,
+                pool,
+                args.partitions,
+            )
+            if pool is not None:
+                pool.close()
+        return
     elif args.command == "index":
         path = Path(args.file)
         result = index.index_file(path)
         console.log(result)
 
+    if args.storage == "memory":
+        # Les tables disparaîtraient avec le processus
+        parser.error("--storage memory is only available for scheme benches")
+
+    # Le serveur et la fusion écrivent les tables tampons et les compteurs :
+    # un seul des deux à la fois
+    if args.command in ("server", "merge") and file.lock(LOCK_PATH) is None:
+        console.error("A server or merge is already running.")
+        raise SystemExit(1)
+
     keyword: bytes = bytes(args.key, "utf-8")
     key: bytes = hmac(keyword)[:32]
 
-    conn = databases.connect_db()
+    storage: Storage
+    if args.storage == "sqlite":
+        storage = SQLiteStorage()
+    else:
+        pool = databases.create_pool(args.pool_min, args.pool_max)
+        storage = PostgresStorage(pool, args.partitions)
+    if args.static:
+        storage = StaticStorage(storage)
 
-    SCHEME = schemes.PiPackPlus(key, conn, 100)
+    SCHEME = schemes.PiBasDyn(key, storage, 100)
 
     match args.command:
         case "server":
-            conn = databases.connect_db()
             if args.reset:
                 console.log("Clearing databases and local files...")
                 console.log("Creating databases...")
                 SCHEME.reset()
 
+            if args.vocabulary is not None:
+                index.stem_cache.load(args.vocabulary)
             w = watcher.Watcher(CLIENT_ROOT, watcher.MyHandler(SCHEME))
             w.run()
+            if args.vocabulary is not None:
+                index.stem_cache.save(args.vocabulary)
 
         case "merge":
-            conn = databases.connect_db()
+            max_memory = None if args.memory is None else args.memory * 2**20
             # Pas de nouvelle clé
             if args.newkey is None:
-                _ = timing.timing(SCHEME.merge)()
+                _ = timing.timing(SCHEME.merge)(max_memory, args.workers)
             else:
                 new_keyword: bytes = bytes(args.newkey, "utf-8")
                 new_key: bytes = hmac(new_keyword)[:32]
                 SCHEME.newkey = new_key
-                _ = timing.timing(SCHEME.merge)()
+                _ = timing.timing(SCHEME.merge)(max_memory, args.workers)
                 SCHEME.key = new_key
                 SCHEME.newkey = None
 
             console.log("merge done.")
 
         case "search":
-            conn = databases.connect_db()
+            if args.cache:
+                SCHEME.cache = SearchCache(key)
             query = args.query
             words = query.split("+")
             words = [word.lower() for word in words]
+            search_word = SCHEME.search_word
+            search_union = SCHEME.search_union
+            search_intersection = SCHEME.search_intersection
+            if args.aio:
+                search_word = run_async(SCHEME, SCHEME.search_word_async, args.pool_max)
+                search_union = run_async(
+                    SCHEME, SCHEME.search_union_async, args.pool_max
+                )
+                search_intersection = run_async(
+                    SCHEME, SCHEME.search_intersection_async, args.pool_max
+                )
             if len(words) == 1:
                 word = words[0]
-                _, results = timing.timing(SCHEME.search_word)(word)
+                _, results = timing.timing(search_word)(word)
             elif len(words) > 1:
                 if args.union:
-                    _, results = timing.timing(SCHEME.search_union)(words)
+                    _, results = timing.timing(search_union)(words)
                 else:
-                    _, results = timing.timing(SCHEME.search_intersection)(words)
+                    _, results = timing.timing(search_intersection)(words)
             else:
                 console.error("No words provided.")
                 results = set()
             if args.show:
-                console.log(results)
+                console.log(SCHEME.resolve(results))
             console.log(f"result: {len(results)} matches.")
+            SCHEME.close()
+
+    if pool is not None:
+        pool.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,321 @@
+"""Microbenchmarks du client : primitives cryptographiques et schémas."""
+
+import os
+import random
+import shutil
+import tempfile
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from functools import partial
+from math import inf
+from pathlib import Path
+from time import perf_counter
+
+from nacl.hash import blake2b
+from psycopg import sql
+from psycopg_pool import ConnectionPool
+
+from miniparsec import crypt, databases, index, schemes, static
+from miniparsec.paths import CLIENT_ROOT, SERVER_ROOT
+from miniparsec.storage import (
+    STATIC_ROOT,
+    MemoryStorage,
+    PostgresStorage,
+    SQLiteStorage,
+    StaticStorage,
+    Storage,
+)
+from miniparsec.utils import console
+
+# Nombre d'exécutions de chaque cas (la meilleure durée est retenue).
+REPEAT = 5
+
+# Préfixe des tables Postgres des benchs de schémas.
+BENCH_PREFIX = "bench_"
+
+# Lignes insérées par COPY, et taille des valeurs, pour les benchs de tables.
+LOAD_BATCH = 100_000
+VALUE_SIZE = 64
+
+
+def measure(function: Callable[[], object], repeat: int = REPEAT) -> float:
+    """Meilleure durée d'exécution de `function` sur `repeat` essais."""
+    best = inf
+    for _ in range(repeat):
+        start = perf_counter()
+        function()
+        best = min(best, perf_counter() - start)
+    return best
+
+
+def report(cases: list[tuple[str, Callable[[], object], int]], unit: str) -> None:
+    for name, function, count in cases:
+        duration = measure(function)
+        console.log(
+            f"{name:<32} {count / duration:>12,.0f} {unit}/s "
+            f"({duration * 1e3:8.1f} ms)"
+        )
+
+
+def nacl_hmac(content: str, key: bytes) -> bytes:
+    """Dérivation d'origine, un appel nacl par clé."""
+    return blake2b(content.encode("utf-8"), key=key)[:32]
+
+
+def bench_keys(count: int = 10_000) -> None:
+    """Compare la dérivation appel par appel et la dérivation par lots."""
+    key = crypt.hmac("bench")
+    words = [f"word{i}" for i in range(count)]
+
+    def tokens_nacl() -> list[tuple[bytes, bytes]]:
+        return [(nacl_hmac(f"edb1{w}", key), nacl_hmac(f"edb2{w}", key)) for w in words]
+
+    def tokens_hmac() -> list[tuple[bytes, bytes]]:
+        return [
+            (crypt.hmac(f"edb1{w}", key), crypt.hmac(f"edb2{w}", key)) for w in words
+        ]
+
+    def tokens_batch() -> list[bytes]:
+        return crypt.hmac_many([f"edb{i}{w}" for w in words for i in (1, 2)], key)
+
+    def counters_nacl() -> list[bytes]:
+        return [nacl_hmac(str(i), key) for i in range(count)]
+
+    def counters_hmac() -> list[bytes]:
+        return [crypt.hmac(str(i), key) for i in range(count)]
+
+    def counters_batch() -> list[bytes]:
+        return crypt.counter_keys(key, 0, count)
+
+    # Les deux chemins dérivent les mêmes clés
+    assert [k for pair in tokens_nacl() for k in pair] == tokens_batch()
+    assert counters_nacl() == counters_batch()
+
+    console.log(f"Key derivation, {count:,d} words and {count:,d} counters:")
+    report(
+        [
+            ("tokens, nacl per call", tokens_nacl, 2 * count),
+            ("tokens, crypt.hmac per call", tokens_hmac, 2 * count),
+            ("tokens, crypt.hmac_many", tokens_batch, 2 * count),
+            ("counters, nacl per call", counters_nacl, count),
+            ("counters, crypt.hmac per call", counters_hmac, count),
+            ("counters, crypt.counter_keys", counters_batch, count),
+        ],
+        "keys",
+    )
+
+
+@contextmanager
+def quiet() -> Iterator[None]:
+    """Masque les logs des fonctions mesurées."""
+    console.console.quiet = True
+    try:
+        yield
+    finally:
+        console.console.quiet = False
+
+
+@contextmanager
+def scratch() -> Iterator[Path]:
+    """Exécute un bench dans un dossier temporaire, supprimé ensuite.
+
+    Les chemins des données (dossiers client et serveur, base SQLite, tables
+    statiques) sont relatifs : ceux du déploiement ne sont pas touchés.
+    """
+    cwd = Path.cwd()
+    with tempfile.TemporaryDirectory(prefix="miniparsec-bench-") as root:
+        os.chdir(root)
+        try:
+            CLIENT_ROOT.mkdir(parents=True)
+            SERVER_ROOT.mkdir(parents=True)
+            yield Path(root)
+        finally:
+            os.chdir(cwd)
+
+
+def bench_schemes(
+    corpus: Path,
+    count: int = 200,
+    backend: str = "memory",
+    static_edb: bool = False,
+    pool: ConnectionPool | None = None,
+    partitions: int = databases.PARTITIONS,
+) -> None:
+    """Compare l'ajout et la recherche des schémas sur un même corpus.
+
+    Chaque schéma est mesuré sur le stockage `backend` (et, avec
+    `static_edb`, sur une EDB statique au-dessus de celui-ci) : en mémoire, la
+    durée mesurée est celle du client seul, sans base de données. Les `count`
+    premiers fichiers du corpus sont copiés dans le dossier client : le serveur
+    et le dossier client sont réinitialisés pour chaque cas. Le bench tourne
+    dans un dossier temporaire, sur des tables Postgres préfixées par
+    `BENCH_PREFIX`.
+    """
+    sources = sorted(path for path in corpus.rglob("*") if path.is_file())[:count]
+    vocabulary: set[str] = set()
+    for source in sources:
+        vocabulary |= index.index_file(source)
+    words = random.Random(0).sample(sorted(vocabulary), min(100, len(vocabulary)))
+
+    key = crypt.hmac("bench")[:32]
+    with scratch():
+        base: Storage
+        if backend == "postgres":
+            assert pool is not None
+            base = PostgresStorage(pool, partitions, BENCH_PREFIX)
+        elif backend == "sqlite":
+            base = SQLiteStorage()
+        else:
+            base = MemoryStorage()
+        storages: list[tuple[str, Storage]] = [(backend, base)]
+        if static_edb:
+            storages.append((f"{backend}+static", StaticStorage(base)))
+        cases: list[tuple[str, schemes.Scheme]] = []
+        for storage_name, storage in storages:
+            cases += [
+                (storage_name, schemes.PiPackPlus(key, storage, 100)),
+                (storage_name, schemes.Sophos(key, storage)),
+                (storage_name, schemes.Diana(key, storage)),
+            ]
+        console.log(f"Schemes, {len(sources)} files, {len(words)} searched words:")
+        for storage_name, scheme in cases:
+            with quiet():
+                scheme.reset()
+                paths = []
+                for i, source in enumerate(sources):
+                    path = CLIENT_ROOT / f"{i}{source.suffix}"
+                    shutil.copyfile(source, path)
+                    paths.append(path)
+
+                start = perf_counter()
+                scheme.add_files_words(paths, verbose=False)
+                ingest = perf_counter() - start
+                start = perf_counter()
+                scheme.merge()
+                merge = perf_counter() - start
+
+                start = perf_counter()
+                for word in words:
+                    scheme.search_word(word)
+                search = (perf_counter() - start) / len(words)
+                for table_name in scheme.tables_names:
+                    scheme.storage.drop(table_name)
+            name = f"{type(scheme).__name__}/{storage_name}"
+            console.log(
+                f"{name:<20} ingest {len(paths) / ingest:8.1f} files/s, "
+                f"merge {merge:6.2f} s, search {search * 1e3:8.2f} ms/word"
+            )
+
+
+def random_rows(
+    rows: int, sample: list[int], tokens: list[bytes]
+) -> Iterator[list[tuple[bytes, bytes]]]:
+    """Lignes aléatoires, par lots.
+
+    Les tokens des lignes dont le numéro est dans `sample` sont ajoutés à `tokens`.
+    """
+    rng = random.Random(1)
+    wanted = iter(sample)
+    target = next(wanted, None)
+    for offset in range(0, rows, LOAD_BATCH):
+        batch = []
+        for i in range(offset, min(offset + LOAD_BATCH, rows)):
+            token = rng.randbytes(databases.TOKEN_SIZE)
+            batch.append((token, rng.randbytes(VALUE_SIZE)))
+            if i == target:
+                tokens.append(token)
+                target = next(wanted, None)
+        yield batch
+
+
+def bench_lookup(
+    pool: ConnectionPool,
+    rows: int = 10_000_000,
+    partitions: int = 8,
+    lookups: int = 1000,
+) -> None:
+    """Compare les index B-tree et hash, et une table statique projetée en mémoire.
+
+    Les index sont mesurés sur une table simple ou partitionnée. Chaque table
+    reçoit `rows` lignes aléatoires, puis `lookups` tokens existants sont
+    cherchés un par un, et par lots.
+    """
+    rng = random.Random(0)
+    sample = sorted(rng.sample(range(rows), min(lookups, rows)))
+    layouts = [
+        ("bench_btree", 0, "btree"),
+        ("bench_hash", 0, "hash"),
+        ("bench_parts", partitions, "hash"),
+    ]
+    console.log(f"Lookups, {rows:,d} rows, {len(sample)} tokens:")
+    for table_name, table_partitions, method in layouts:
+        tokens: list[bytes] = []
+        with databases.connection(pool) as conn:
+            with quiet():
+                databases.drop_table(conn, table_name)
+            databases.create_edb_table(conn, table_name, table_partitions, method)
+
+            start = perf_counter()
+            for batch in random_rows(rows, sample, tokens):
+                databases.copy_rows(conn, table_name, batch)
+                conn.commit()
+            load = perf_counter() - start
+            conn.execute(sql.SQL("ANALYZE {}").format(sql.Identifier(table_name)))
+            # Une table simple n'a pas d'arbre de partitions
+            (size,) = conn.execute(
+                "SELECT coalesce(sum(pg_total_relation_size(relid)), "
+                "pg_total_relation_size(to_regclass(%s))) "
+                "FROM pg_partition_tree(to_regclass(%s))",
+                (table_name, table_name),
+            ).fetchone() or (0,)
+
+            def single(table_name: str, tokens: list[bytes]) -> None:
+                for token in tokens:
+                    databases.select_rows(conn, table_name, [token])
+
+            def grouped(table_name: str, tokens: list[bytes]) -> None:
+                databases.select_rows(conn, table_name, tokens)
+
+            single_time = measure(partial(single, table_name, tokens))
+            grouped_time = measure(partial(grouped, table_name, tokens))
+            with quiet():
+                databases.drop_table(conn, table_name)
+        console.log(
+            f"{table_name:<12} ({table_partitions:2d} partitions) "
+            f"load {rows / load:10,.0f} rows/s, "
+            f"size {size / 2**20:8,.1f} MiB, "
+            f"single {single_time / len(tokens) * 1e6:8.1f} µs/token, "
+            f"grouped {grouped_time / len(tokens) * 1e6:8.1f} µs/token"
+        )
+
+    # Même contenu, dans un fichier statique construit d'une traite
+    tokens = []
+    path = STATIC_ROOT / "bench.static"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    start = perf_counter()
+    static.write_table(
+        path,
+        (row for batch in random_rows(rows, sample, tokens) for row in batch),
+        rows,
+    )
+    load = perf_counter() - start
+    size = path.stat().st_size
+
+    def static_single(table: static.StaticTable) -> None:
+        for token in tokens:
+            table.get(token)
+
+    def static_grouped(table: static.StaticTable) -> None:
+        table.get_many(tokens)
+
+    with static.StaticTable(path) as table:
+        single_time = measure(partial(static_single, table))
+        grouped_time = measure(partial(static_grouped, table))
+    path.unlink()
+    console.log(
+        f"{'static':<12} (  mmap    ) "
+        f"load {rows / load:10,.0f} rows/s, "
+        f"size {size / 2**20:8,.1f} MiB, "
+        f"single {single_time / len(tokens) * 1e6:8.1f} µs/token, "
+        f"grouped {grouped_time / len(tokens) * 1e6:8.1f} µs/token"
+    )
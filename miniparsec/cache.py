@@ -0,0 +1,119 @@
+"""Cache client des listes de documents par mot, chiffré entre deux invocations."""
+
+import sys
+from collections import OrderedDict
+from collections.abc import Hashable, Iterable
+
+from nacl.exceptions import CryptoError
+
+from miniparsec import crypt
+from miniparsec.paths import SERVER_ROOT
+from miniparsec.utils import console
+
+# Taille maximale par défaut du cache, en octets.
+CACHE_BYTES = 64 * 2**20
+
+
+class SearchCache:
+    """Cache LRU des listes de documents décodées, borné en octets.
+
+    Chaque entrée est associée à une version (les compteurs du mot et la
+    génération des tables au moment de la recherche) : une entrée dont la
+    version ne correspond plus est périmée, même si elle a été écrite par un
+    autre processus. Les entrées sont aussi invalidées explicitement lors des
+    ajouts et des fusions.
+    """
+
+    def __init__(
+        self, key: bytes, max_bytes: int = CACHE_BYTES, name: str = "search_cache"
+    ) -> None:
+        self.key: bytes = key
+        self.max_bytes: int = max_bytes
+        self.path = SERVER_ROOT / name
+        self.entries: OrderedDict[str, tuple[Hashable, list[int | str]]]
+        self.entries = OrderedDict()
+        self.size: int = 0
+        self.hits: int = 0
+        self.misses: int = 0
+        self.loaded: bool = False
+        self.modified: bool = False
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        state.update(entries=OrderedDict(), size=0, loaded=False, modified=False)
+        return state
+
+    @staticmethod
+    def entry_size(word: str, documents: list[int | str]) -> int:
+        return sys.getsizeof(word) + sum(
+            sys.getsizeof(document) + 8 for document in documents
+        )
+
+    def load(self) -> None:
+        if self.loaded:
+            return
+        self.loaded = True
+        try:
+            with open(self.path, "rb") as f:
+                entries = crypt.loads(f.read(), self.key)
+        except FileNotFoundError:
+            return
+        except CryptoError:
+            console.warning("Search cache encrypted with another key, discarded.")
+            return
+        for word, (version, documents) in entries:
+            self.put(word, version, documents)
+        self.modified = False
+
+    def save(self) -> None:
+        if not self.modified:
+            return
+        crypt.write_atomic(self.path, crypt.dumps(list(self.entries.items()), self.key))
+        self.modified = False
+
+    def get(self, word: str, version: Hashable) -> list[int | str] | None:
+        self.load()
+        entry = self.entries.get(word)
+        if entry is None or entry[0] != version:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(word)
+        return entry[1]
+
+    def put(self, word: str, version: Hashable, documents: list[int | str]) -> None:
+        self.load()
+        self.invalidate((word,))
+        size = self.entry_size(word, documents)
+        if size > self.max_bytes:
+            return
+        self.entries[word] = (version, documents)
+        self.size += size
+        self.modified = True
+        while self.size > self.max_bytes:
+            old_word, (_, old_documents) = self.entries.popitem(last=False)
+            self.size -= self.entry_size(old_word, old_documents)
+
+    def invalidate(self, words: Iterable[str]) -> None:
+        self.load()
+        for word in words:
+            entry = self.entries.pop(word, None)
+            if entry is not None:
+                self.size -= self.entry_size(word, entry[1])
+                self.modified = True
+
+    def clear(self, key: bytes | None = None) -> None:
+        if key is not None:
+            self.key = key
+        self.entries.clear()
+        self.size = 0
+        self.loaded = True
+        self.modified = True
+
+    def stats(self) -> str:
+        total = self.hits + self.misses
+        ratio = self.hits / total if total else 0.0
+        return (
+            f"Cache: {self.hits} hits, {self.misses} misses ({ratio:.0%}), "
+            f"{len(self.entries)} words, {self.size:,d} bytes."
+        )
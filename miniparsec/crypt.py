@@ -1,19 +1,66 @@
+import hashlib
+import os
 import pickle
+import tempfile
+import zlib
+from collections.abc import Iterable, Iterator
 from pathlib import Path
-from typing import Any
+from typing import Any, BinaryIO
 
+import nacl.bindings as aead
 import nacl.secret
 import nacl.utils
-from nacl.hash import blake2b
 
-from miniparsec.paths import CLIENT_ROOT, SERVER_ROOT
+from miniparsec.paths import SERVER_ROOT
 from miniparsec.utils import console, file
 
+# Format des fichiers chiffrés : un en-tête (signature, version, préfixe des
+# nonces), puis des morceaux de `FILE_CHUNK_SIZE` octets chiffrés séparément
+# (XChaCha20-Poly1305), déchiffrables individuellement.
+FILE_MAGIC = b"MPSF"
+FILE_VERSION = 1
+FILE_CHUNK_SIZE = 2**16
+NONCE_PREFIX_SIZE = 16
+HEADER_SIZE = len(FILE_MAGIC) + 1 + NONCE_PREFIX_SIZE
+ENCRYPTED_CHUNK_SIZE = FILE_CHUNK_SIZE + aead.crypto_aead_xchacha20poly1305_ietf_ABYTES
+
+# Préfixe des objets sérialisés compressés. Un pickle commence toujours par
+# l'octet 0x80 : les objets non compressés et les anciens fichiers restent lisibles.
+COMPRESSED = b"Z"
+COMPRESSION_LEVEL = 1
+
+# Taille du condensé BLAKE2b (celle de nacl par défaut) : les clés dérivées sont
+# les 32 premiers caractères de son écriture hexadécimale.
+DIGEST_SIZE = 32
+
 
 def hmac(content: str | bytes, key: bytes = b"") -> bytes:
     if isinstance(content, str):
         content = content.encode("utf-8")
-    return blake2b(content, key=key)[:32]
+    digest = hashlib.blake2b(content, key=key, digest_size=DIGEST_SIZE)
+    return digest.hexdigest()[:32].encode("ascii")
+
+
+def hmac_many(contents: Iterable[str | bytes], key: bytes = b"") -> list[bytes]:
+    """`hmac` de plusieurs contenus avec la même clé.
+
+    L'état initial, qui dépend seulement de la clé, est calculé une fois puis
+    copié pour chaque contenu.
+    """
+    state = hashlib.blake2b(key=key, digest_size=DIGEST_SIZE)
+    keys = []
+    for content in contents:
+        if isinstance(content, str):
+            content = content.encode("utf-8")
+        digest = state.copy()
+        digest.update(content)
+        keys.append(digest.hexdigest()[:32].encode("ascii"))
+    return keys
+
+
+def counter_keys(key: bytes, start: int, stop: int) -> list[bytes]:
+    """Clés des entrées numérotées de `start` (inclus) à `stop` (exclu)."""
+    return hmac_many((str(i) for i in range(start, stop)), key)
 
 
 def encrypt(content: str | bytes, key: bytes) -> bytes:
@@ -23,74 +70,183 @@ def encrypt(content: str | bytes, key: bytes) -> bytes:
     return box.encrypt(content)
 
 
-def decrypt(content: bytes, key: bytes) -> bytes:
+def decrypt(content: bytes | memoryview, key: bytes) -> bytes:
     box = nacl.secret.SecretBox(key)
-    return box.decrypt(content)
+    # nacl n'accepte que des bytes (une valeur lue par `mmap` est copiée ici)
+    return box.decrypt(bytes(content))
+
+
+def file_header(nonce_prefix: bytes) -> bytes:
+    return FILE_MAGIC + bytes((FILE_VERSION,)) + nonce_prefix
+
+
+def chunk_parameters(header: bytes, index: int, final: bool) -> tuple[bytes, bytes]:
+    """Nonce et données associées du `index`-ième morceau d'un fichier.
+
+    L'en-tête, le numéro du morceau et le drapeau de fin sont authentifiés :
+    un morceau ne peut être ni déplacé, ni retiré en fin de fichier.
+    """
+    nonce = header[-NONCE_PREFIX_SIZE:] + index.to_bytes(8, "big")
+    aad = header + index.to_bytes(8, "big") + bytes((final,))
+    return nonce, aad
+
+
+def encrypt_chunk(
+    chunk: bytes, header: bytes, index: int, final: bool, key: bytes
+) -> bytes:
+    nonce, aad = chunk_parameters(header, index, final)
+    return aead.crypto_aead_xchacha20poly1305_ietf_encrypt(chunk, aad, nonce, key)
+
+
+def decrypt_chunk(
+    encrypted: bytes, header: bytes, index: int, final: bool, key: bytes
+) -> bytes:
+    nonce, aad = chunk_parameters(header, index, final)
+    return aead.crypto_aead_xchacha20poly1305_ietf_decrypt(encrypted, aad, nonce, key)
+
+
+def encrypt_stream(source: BinaryIO, target: BinaryIO, key: bytes) -> None:
+    """Chiffre un flux par morceaux de `FILE_CHUNK_SIZE` octets."""
+    header = file_header(nacl.utils.random(NONCE_PREFIX_SIZE))
+    target.write(header)
+    index = 0
+    chunk = source.read(FILE_CHUNK_SIZE)
+    while True:
+        next_chunk = source.read(FILE_CHUNK_SIZE)
+        final = not next_chunk
+        target.write(encrypt_chunk(chunk, header, index, final, key))
+        if final:
+            return
+        chunk = next_chunk
+        index += 1
+
+
+def decrypt_stream(source: BinaryIO, key: bytes) -> Iterator[bytes]:
+    """Déchiffre un fichier chiffré par `encrypt_file`, morceau par morceau.
+
+    Les fichiers chiffrés d'un seul bloc par une ancienne version (sans
+    en-tête) sont déchiffrés en entier.
+    """
+    header = source.read(HEADER_SIZE)
+    if not is_chunked(header):
+        yield decrypt(header + source.read(), key)
+        return
+    index = 0
+    encrypted = source.read(ENCRYPTED_CHUNK_SIZE)
+    while True:
+        next_encrypted = source.read(ENCRYPTED_CHUNK_SIZE)
+        final = not next_encrypted
+        yield decrypt_chunk(encrypted, header, index, final, key)
+        if final:
+            return
+        encrypted = next_encrypted
+        index += 1
+
+
+def is_chunked(header: bytes) -> bool:
+    return (
+        len(header) == HEADER_SIZE
+        and header.startswith(FILE_MAGIC)
+        and header[len(FILE_MAGIC)] == FILE_VERSION
+    )
 
 
 def encrypt_file(client_path: Path, key: bytes) -> None:
-    box = nacl.secret.SecretBox(key)
     server_path = file.get_server_path(client_path)
     try:
-        with open(client_path, "rb") as f:
-            encrypted = box.encrypt(f.read())
-            with open(server_path, "wb") as ef:
-                ef.write(encrypted)
+        with open(client_path, "rb") as f, open(server_path, "wb") as ef:
+            encrypt_stream(f, ef, key)
     except FileNotFoundError:
         console.log("File to encrypt not found.")
 
 
 def decrypt_file(server_path: Path, key: bytes, basename: str = "") -> None:
-    box = nacl.secret.SecretBox(key)
     client_path = file.get_client_path(server_path)
     if basename:
         client_path = file.rename(client_path, basename)
     try:
-        with open(server_path, "rb") as f:
-            decrypted = box.decrypt(f.read())
-            try:
-                with open(client_path, "wb") as ef:
-                    ef.write(decrypted)
-            except Exception as e:
-                console.error(e)
+        with open(server_path, "rb") as ef, open(client_path, "wb") as f:
+            for chunk in decrypt_stream(ef, key):
+                f.write(chunk)
     except FileNotFoundError:
         console.log("File to decrypt not found.")
+    except Exception as e:
+        # Pas de fichier partiellement déchiffré
+        console.error(e)
+        client_path.unlink(missing_ok=True)
+
+
+def decrypt_range(server_path: Path, key: bytes, start: int, length: int) -> bytes:
+    """Déchiffre `length` octets du fichier à partir de `start`.
+
+    Seuls les morceaux concernés sont lus et déchiffrés (un fichier d'une
+    ancienne version est déchiffré en entier).
+    """
+    with open(server_path, "rb") as ef:
+        header = ef.read(HEADER_SIZE)
+        size = ef.seek(0, os.SEEK_END)
+        if not is_chunked(header):
+            ef.seek(0)
+            return decrypt(ef.read(), key)[start : start + length]
+
+        chunks = max(1, -(-(size - HEADER_SIZE) // ENCRYPTED_CHUNK_SIZE))
+        first = start // FILE_CHUNK_SIZE
+        last = min((start + length - 1) // FILE_CHUNK_SIZE, chunks - 1)
+        ef.seek(HEADER_SIZE + first * ENCRYPTED_CHUNK_SIZE)
+        plaintext = b"".join(
+            decrypt_chunk(
+                ef.read(ENCRYPTED_CHUNK_SIZE), header, index, index == chunks - 1, key
+            )
+            for index in range(first, last + 1)
+        )
+    offset = start - first * FILE_CHUNK_SIZE
+    return plaintext[offset : offset + length]
+
+
+def dumps(content: Any, key: bytes, compress: bool = True) -> bytes:
+    """Sérialise et chiffre un objet en mémoire, compressé si `compress`."""
+    data = pickle.dumps(content, protocol=pickle.HIGHEST_PROTOCOL)
+    if compress:
+        data = COMPRESSED + zlib.compress(data, COMPRESSION_LEVEL)
+    return encrypt(data, key)
+
+
+def loads(content: bytes, key: bytes) -> Any:
+    """Déchiffre et désérialise un objet écrit par `dumps` (ou un pickle brut)."""
+    data = decrypt(content, key)
+    if data.startswith(COMPRESSED):
+        data = zlib.decompress(data[len(COMPRESSED) :])
+    return pickle.loads(data)
+
+
+def write_atomic(path: Path, content: bytes) -> None:
+    """Écrit un fichier d'un seul coup : jamais à moitié écrit.
+
+    Le contenu est écrit sur le disque dans un fichier temporaire propre à
+    l'appel, dans le même dossier, qui remplace ensuite `path`.
+    """
+    fd, temp_name = tempfile.mkstemp(prefix=f"{path.name}.", dir=path.parent)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_name, path)
+    except BaseException:
+        Path(temp_name).unlink(missing_ok=True)
+        raise
 
 
-def encrypt_pickle(pickle_file: Any, filename: str, key: bytes) -> None:
-    box = nacl.secret.SecretBox(key)
-    server_path = SERVER_ROOT / filename
-    client_path = CLIENT_ROOT / f"{filename}.pkl"
-
-    # Dump pickle
-    with open(client_path, "wb") as f:
-        pickle.dump(pickle_file, f)
-
-    # Encrypt and upload file
-    with open(client_path, "rb") as f:
-        pickle_file = box.encrypt(f.read())
-        with open(server_path, "wb") as ef:
-            ef.write(pickle_file)
+def encrypt_pickle(
+    pickle_file: Any, filename: str, key: bytes, compress: bool = True
+) -> None:
+    write_atomic(SERVER_ROOT / filename, dumps(pickle_file, key, compress))
 
 
 def decrypt_pickle(filename: str, key: bytes, defaultvalue: Any) -> Any:
-    box = nacl.secret.SecretBox(key)
-    server_path = SERVER_ROOT / filename
-    client_path = CLIENT_ROOT / f"{filename}.pkl"
-
-    # Download and decrypt file
     try:
-        with open(server_path, "rb") as ef:
-            pickle_file = box.decrypt(ef.read())
-            with open(client_path, "wb") as f:
-                f.write(pickle_file)
+        with open(SERVER_ROOT / filename, "rb") as ef:
+            return loads(ef.read(), key)
     except FileNotFoundError:
         console.error("Pickle file not found.")
-
-    # Read pickle
-    try:
-        with open(client_path, "rb") as f:
-            pickle_file = pickle.load(f)
-    except FileNotFoundError:
-        pickle_file = defaultvalue
-    return pickle_file
+        return defaultvalue
@@ -1,16 +1,140 @@
+from collections.abc import AsyncIterator, Iterable, Iterator
+from contextlib import asynccontextmanager, contextmanager
+from time import monotonic
+from typing import Any
+
 import psycopg
-from psycopg import Connection, sql
+from psycopg import AsyncConnection, Connection, sql
+from psycopg_pool import AsyncConnectionPool, ConnectionPool
 
 from miniparsec.utils import console
 
+DB_PARAMS: dict[str, Any] = {
+    "dbname": "mini-parsec",
+    "host": "localhost",
+    "user": "admin",
+    "port": "5432",
+}
+
+# Tailles par défaut des pools de connexions.
+POOL_MIN_SIZE = 1
+POOL_MAX_SIZE = 8
+
+# Inactivité (en secondes) au-delà de laquelle une connexion est vérifiée.
+CHECK_IDLE = 30.0
+
+# Tables chiffrées : nombre de partitions par hash du token (0 : table simple),
+# taille des tokens, index et paramètres de stockage. Les tokens sont
+# uniformément aléatoires : un B-tree n'apporte aucune localité. Les lignes ne
+# sont jamais mises à jour (pas de place à réserver pour HOT), et les fusions
+# suppriment des lignes : le vacuum passe plus tôt que par défaut.
+PARTITIONS = 0
+TOKEN_SIZE = 32
+INDEX_METHOD = "hash"
+TABLE_OPTIONS = {"fillfactor": 100, "autovacuum_vacuum_scale_factor": 0.05}
+INDEX_FILLFACTOR = 90
+
+# Dernière utilisation de chaque connexion empruntée, par `id`.
+last_used: dict[int, float] = {}
+
 
 def connect_db() -> Connection:
-    conn = psycopg.connect(
-        dbname="mini-parsec", host="localhost", user="admin", port="5432"
-    )
+    conn = psycopg.connect(**DB_PARAMS)
     return conn
 
 
+async def connect_db_async() -> AsyncConnection:
+    conn = await AsyncConnection.connect(**DB_PARAMS)
+    return conn
+
+
+def create_pool(
+    min_size: int = POOL_MIN_SIZE, max_size: int = POOL_MAX_SIZE
+) -> ConnectionPool:
+    pool = ConnectionPool(
+        kwargs=DB_PARAMS, min_size=min_size, max_size=max_size, open=False
+    )
+    pool.open(wait=True)
+    console.log(f"Connection pool opened ({min_size}-{max_size} connections).")
+    return pool
+
+
+def create_async_pool(
+    min_size: int = POOL_MIN_SIZE, max_size: int = POOL_MAX_SIZE
+) -> AsyncConnectionPool:
+    """Pool asynchrone, à ouvrir dans la boucle qui l'utilise (`async with`)."""
+    return AsyncConnectionPool(
+        kwargs=DB_PARAMS, min_size=min_size, max_size=max_size, open=False
+    )
+
+
+def needs_check(conn: Connection | AsyncConnection) -> bool:
+    return monotonic() - last_used.get(id(conn), 0.0) > CHECK_IDLE
+
+
+def check_connection(conn: Connection) -> bool:
+    """Vérifie qu'une connexion inactive répond encore."""
+    try:
+        conn.execute("SELECT 1")
+        conn.rollback()
+    except psycopg.OperationalError:
+        return False
+    return True
+
+
+async def check_connection_async(conn: AsyncConnection) -> bool:
+    try:
+        await conn.execute("SELECT 1")
+        await conn.rollback()
+    except psycopg.OperationalError:
+        return False
+    return True
+
+
+@contextmanager
+def connection(pool: ConnectionPool) -> Iterator[Connection]:
+    """Emprunte une connexion au pool pour une opération.
+
+    Une connexion restée inactive est vérifiée avant usage ; si elle ne répond
+    plus, elle est rendue au pool (qui la remplace) et une autre est empruntée.
+    La transaction est validée à la fin du bloc, ou annulée en cas d'erreur.
+    """
+    conn = pool.getconn()
+    if needs_check(conn) and not check_connection(conn):
+        console.warning("Broken connection returned to the pool.")
+        pool.putconn(conn)
+        conn = pool.getconn()
+    try:
+        yield conn
+        conn.commit()
+    except BaseException:
+        if not conn.broken:
+            conn.rollback()
+        raise
+    finally:
+        last_used[id(conn)] = monotonic()
+        pool.putconn(conn)
+
+
+@asynccontextmanager
+async def connection_async(pool: AsyncConnectionPool) -> AsyncIterator[AsyncConnection]:
+    conn = await pool.getconn()
+    if needs_check(conn) and not await check_connection_async(conn):
+        console.warning("Broken connection returned to the pool.")
+        await pool.putconn(conn)
+        conn = await pool.getconn()
+    try:
+        yield conn
+        await conn.commit()
+    except BaseException:
+        if not conn.broken:
+            await conn.rollback()
+        raise
+    finally:
+        last_used[id(conn)] = monotonic()
+        await pool.putconn(conn)
+
+
 def drop_table(conn: Connection, table_name: str) -> None:
     cursor = conn.cursor()
     query = sql.SQL("DROP TABLE {}").format(sql.Identifier(table_name))
@@ -24,17 +148,63 @@ def drop_table(conn: Connection, table_name: str) -> None:
     conn.commit()
 
 
-def create_table(conn: Connection, table_name: str, columns: dict[str, str]) -> None:
+def storage_options(options: dict[str, int | float]) -> sql.Composable:
+    return sql.SQL(", ").join(
+        sql.SQL("{} = {}").format(sql.SQL(name), sql.Literal(value))
+        for name, value in options.items()
+    )
+
+
+def create_edb_table(
+    conn: Connection,
+    table_name: str,
+    partitions: int = PARTITIONS,
+    method: str = INDEX_METHOD,
+) -> None:
+    """Crée une table chiffrée (token, file) et son index, en une transaction.
+
+    Avec `partitions > 0`, la table est partitionnée par hash du token : les
+    insertions et la maintenance (vacuum, index) se répartissent entre les
+    partitions, mais une requête `token = ANY(...)` parcourt chacune d'elles.
+    """
     cursor = conn.cursor()
-    query = sql.SQL("CREATE TABLE {} ()").format(sql.Identifier(table_name))
-    cursor.execute(query)
-    for name, dtype in columns.items():
-        query = sql.SQL("ALTER TABLE {} ADD COLUMN {} {}").format(
+    columns = sql.SQL(
+        "token bytea NOT NULL CHECK (octet_length(token) = {}), file bytea NOT NULL"
+    ).format(sql.Literal(TOKEN_SIZE))
+    options = storage_options(TABLE_OPTIONS)
+    if partitions:
+        cursor.execute(
+            sql.SQL("CREATE TABLE {} ({}) PARTITION BY HASH (token)").format(
+                sql.Identifier(table_name), columns
+            )
+        )
+        for i in range(partitions):
+            cursor.execute(
+                sql.SQL(
+                    "CREATE TABLE {} PARTITION OF {} "
+                    "FOR VALUES WITH (MODULUS {}, REMAINDER {}) WITH ({})"
+                ).format(
+                    sql.Identifier(f"{table_name}_p{i}"),
+                    sql.Identifier(table_name),
+                    sql.Literal(partitions),
+                    sql.Literal(i),
+                    options,
+                )
+            )
+    else:
+        cursor.execute(
+            sql.SQL("CREATE TABLE {} ({}) WITH ({})").format(
+                sql.Identifier(table_name), columns, options
+            )
+        )
+    cursor.execute(
+        sql.SQL("CREATE INDEX {} ON {} USING {} (token) WITH (fillfactor = {})").format(
+            sql.Identifier(f"idx_{table_name}"),
             sql.Identifier(table_name),
-            sql.Identifier(name),
-            sql.Identifier(dtype),
+            sql.SQL(method),
+            sql.Literal(INDEX_FILLFACTOR),
         )
-        cursor.execute(query)
+    )
     conn.commit()
 
 
@@ -51,10 +221,117 @@ def truncate_table(conn: Connection, table_name: str) -> None:
     conn.commit()
 
 
-def create_index(conn: Connection, table_name: str) -> None:
+def copy_rows(
+    conn: Connection, table_name: str, rows: Iterable[tuple[bytes, bytes]]
+) -> int:
+    """Insère des lignes (token, file) en flux via `COPY ... FORMAT BINARY`."""
     cursor = conn.cursor()
-    query = sql.SQL("CREATE INDEX {} ON {}(token);").format(
-        sql.Identifier(f"idx_{table_name}"), sql.Identifier(table_name)
+    query = sql.SQL("COPY {} (token, file) FROM STDIN (FORMAT BINARY)").format(
+        sql.Identifier(table_name)
     )
-    cursor.execute(query)
+    count = 0
+    with cursor.copy(query) as copy:
+        copy.set_types(["bytea", "bytea"])
+        for row in rows:
+            copy.write_row(row)
+            count += 1
+    return count
+
+
+def select_rows(
+    conn: Connection, table_name: str, tokens: list[bytes], batch_size: int = 1000
+) -> dict[bytes, list[bytes]]:
+    """Lignes de plusieurs tokens, par requêtes `token = ANY(...)` groupées."""
+    found: dict[bytes, list[bytes]] = {}
+    cursor = conn.cursor()
+    query = sql.SQL("SELECT token, file FROM {} WHERE token = ANY(%s)").format(
+        sql.Identifier(table_name)
+    )
+    for i in range(0, len(tokens), batch_size):
+        cursor.execute(query, (tokens[i : i + batch_size],))
+        for token, file in cursor.fetchall():
+            found.setdefault(bytes(token), []).append(file)
+    return found
+
+
+async def select_rows_async(
+    conn: AsyncConnection,
+    table_name: str,
+    tokens: list[bytes],
+    batch_size: int = 1000,
+) -> dict[bytes, list[bytes]]:
+    """Variante asynchrone de `select_rows`."""
+    found: dict[bytes, list[bytes]] = {}
+    cursor = conn.cursor()
+    query = sql.SQL("SELECT token, file FROM {} WHERE token = ANY(%s)").format(
+        sql.Identifier(table_name)
+    )
+    for i in range(0, len(tokens), batch_size):
+        await cursor.execute(query, (tokens[i : i + batch_size],))
+        for token, file in await cursor.fetchall():
+            found.setdefault(bytes(token), []).append(file)
+    return found
+
+
+def read_rows(conn: Connection, table_name: str) -> Iterator[tuple[bytes, bytes]]:
+    """Toutes les lignes (token, file) d'une table, lues en flux."""
+    cursor = conn.cursor()
+    # `COPY table TO` n'accepte pas les tables partitionnées
+    query = sql.SQL(
+        "COPY (SELECT token, file FROM {}) TO STDOUT (FORMAT BINARY)"
+    ).format(sql.Identifier(table_name))
+    with cursor.copy(query) as copy:
+        copy.set_types(["bytea", "bytea"])
+        for token, file in copy.rows():
+            yield bytes(token), bytes(file)
+
+
+def delete_rows(conn: Connection, table_name: str, tokens: list[bytes]) -> None:
+    if not tokens:
+        return
+    cursor = conn.cursor()
+    query = sql.SQL("DELETE FROM {} WHERE token = ANY(%s)").format(
+        sql.Identifier(table_name)
+    )
+    cursor.execute(query, (tokens,))
+
+
+def table_exists(conn: Connection, table_name: str) -> bool:
+    cursor = conn.execute("SELECT to_regclass(%s) IS NOT NULL", (table_name,))
+    (exists,) = cursor.fetchone() or (False,)
+    return exists
+
+
+def partitions_names(conn: Connection, relation_name: str) -> list[str]:
+    """Partitions d'une table ou d'un index partitionné (aucune sinon)."""
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = to_regclass(%s)",
+        (relation_name,),
+    )
+    return [name for name, in cursor.fetchall()]
+
+
+def replace_table(conn: Connection, source_name: str, table_name: str) -> None:
+    """Remplace `table_name` par `source_name` (et son index, et leurs partitions)."""
+    cursor = conn.cursor()
+    cursor.execute(
+        sql.SQL("DROP TABLE IF EXISTS {}").format(sql.Identifier(table_name))
+    )
+    # Les partitions sont renommées avec leur table, pour libérer leurs noms
+    renames = [("TABLE", source_name, table_name)]
+    renames.append(("INDEX", f"idx_{source_name}", f"idx_{table_name}"))
+    for kind, old_name, new_name in renames[:2]:
+        for partition in partitions_names(conn, old_name):
+            if partition.startswith(source_name):
+                suffix = partition.removeprefix(source_name)
+                renames.append((kind, partition, f"{table_name}{suffix}"))
+    for kind, old_name, new_name in renames:
+        cursor.execute(
+            sql.SQL("ALTER {} IF EXISTS {} RENAME TO {}").format(
+                sql.SQL(kind), sql.Identifier(old_name), sql.Identifier(new_name)
+            )
+        )
     conn.commit()
+    console.log(f"Table '{table_name}' replaced by '{source_name}'.")
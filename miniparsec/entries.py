@@ -0,0 +1,89 @@
+"""Encodage binaire des entrées (paquets de documents) stockées dans EDB.
+
+Format version 2 : un octet de version, puis les identifiants de documents
+(uint32). Format version 1 : un octet de version, le nombre de chemins
+(uint32), leurs longueurs en octets (uint16), puis les chemins UTF-8
+concaténés. Les formats antérieurs (version 1 et `str(set)`) restent lisibles
+pendant la migration.
+"""
+
+import ast
+import sys
+from array import array
+from collections.abc import Iterable
+from itertools import accumulate
+
+VERSION_PATHS = 1
+VERSION_IDS = 2
+
+LEGACY_PREFIXES = (b"{", b"set()")
+
+# Les tableaux sont stockés en petit-boutiste
+SWAP = sys.byteorder != "little"
+
+
+def encode(paths: Iterable[str]) -> bytes:
+    """Encode un paquet de chemins."""
+    encoded = [path.encode("utf-8") for path in paths]
+    lengths = array("H", [len(path) for path in encoded])
+    if SWAP:
+        lengths.byteswap()
+    return b"".join(
+        (
+            bytes((VERSION_PATHS,)),
+            len(encoded).to_bytes(4, "little"),
+            lengths.tobytes(),
+            *encoded,
+        )
+    )
+
+
+def encode_ids(ids: Iterable[int]) -> bytes:
+    """Encode un paquet d'identifiants de documents."""
+    array_ids = array("I", ids)
+    if SWAP:
+        array_ids.byteswap()
+    return bytes((VERSION_IDS,)) + array_ids.tobytes()
+
+
+def decode(data: bytes) -> list[int] | list[str]:
+    """Décode un paquet d'identifiants, ou de chemins dans un ancien format."""
+    version = data[0]
+    if version == VERSION_IDS:
+        ids = array("I")
+        ids.frombytes(data[1:])
+        if SWAP:
+            ids.byteswap()
+        return ids.tolist()
+    if data.startswith(LEGACY_PREFIXES):
+        return list(ast.literal_eval(data.decode("utf-8")))
+    if version != VERSION_PATHS:
+        raise ValueError(f"Unknown entry encoding version {version}.")
+    count = int.from_bytes(data[1:5], "little")
+    lengths = array("H")
+    lengths.frombytes(data[5 : 5 + 2 * count])
+    if SWAP:
+        lengths.byteswap()
+    blob = data[5 + 2 * count :]
+    offsets = [0, *accumulate(lengths)]
+    text = blob.decode("utf-8")
+    if len(text) != len(blob):
+        # Caractères non ASCII : les longueurs en octets ne s'appliquent pas au str
+        view = memoryview(blob)
+        return [
+            str(view[start:end], "utf-8") for start, end in zip(offsets, offsets[1:])
+        ]
+    return [text[start:end] for start, end in zip(offsets, offsets[1:])]
+
+
+def pack(documents: Iterable[int | str], size: int) -> list[bytes]:
+    """Regroupe des documents en paquets encodés d'au plus `size` éléments.
+
+    Les identifiants sont triés et encodés en version 2 ; les chemins d'un
+    ancien format, sans identifiant connu, sont gardés en version 1.
+    """
+    ids = sorted(d for d in documents if isinstance(d, int))
+    paths = sorted(d for d in documents if isinstance(d, str))
+    packs = [encode_ids(ids[i : i + size]) for i in range(0, len(ids), size)]
+    packs += [encode(paths[i : i + size]) for i in range(0, len(paths), size)]
+    return packs
@@ -1,17 +1,42 @@
+import codecs
+import email
+import email.policy
+import mmap
 import re
+import threading
+from collections.abc import Callable, Iterable, Iterator
 from pathlib import Path
+from time import monotonic
+from typing import overload
 
+import charset_normalizer
 import Stemmer
 import textract
-from textract.exceptions import ExtensionNotSupported
 from unidecode import unidecode
 
+from miniparsec import crypt
 from miniparsec.utils import console
 
-stemmer = Stemmer.Stemmer("english")
+# Un stemmer ne peut pas être partagé entre threads : un par thread
+local = threading.local()
 
 REGEX = r"[a-zA-Z]+"
 
+# Mots du texte brut (lettres Unicode), translittérés ensuite un par un.
+WORD = re.compile(r"[^\W\d_]+")
+
+# Mot éventuellement coupé en fin de morceau.
+TRAILING_WORD = re.compile(r"[^\W\d_]+\Z")
+
+# Nombre maximal de mots gardés dans le cache des stems.
+STEM_CACHE_SIZE = 500_000
+
+# Taille des morceaux lus (en octets) et tokenisés (en caractères).
+CHUNK_SIZE = 2**20
+
+# Taille de l'échantillon utilisé pour détecter un encodage.
+SAMPLE_SIZE = 2**16
+
 EXTENSIONS = {
     ".csv",
     ".doc",
@@ -47,11 +72,268 @@ EXTENSIONS = {
 }
 
 
+# Formats texte lus directement, sans passer par textract.
+TEXT_EXTENSIONS = {".csv", ".json", ".log", ".psv", ".tab", ".tsv", ".txt"}
+
+# Durées d'extraction cumulées, par extracteur.
+extraction_stats: dict[str, dict] = {}
+stats_lock = threading.Lock()
+
+
+def detect_encoding(sample: bytes) -> str:
+    match = charset_normalizer.from_bytes(sample).best()
+    return match.encoding if match is not None else "latin-1"
+
+
+def decode(data: bytes) -> str:
+    """Décode un texte : UTF-8, sinon l'encodage détecté, sinon Latin-1."""
+    try:
+        return data.decode("utf-8")
+    except UnicodeDecodeError:
+        pass
+    return data.decode(detect_encoding(data[:SAMPLE_SIZE]), errors="replace")
+
+
+def read_blocks(path: Path) -> Iterator[bytes]:
+    """Lit un fichier par blocs de `CHUNK_SIZE` octets, via mmap si possible."""
+    with open(path, "rb") as f:
+        try:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            # Fichier vide ou non projetable
+            while block := f.read(CHUNK_SIZE):
+                yield block
+            return
+        with mapped:
+            for start in range(0, len(mapped), CHUNK_SIZE):
+                yield mapped[start : start + CHUNK_SIZE]
+
+
+def extract_text(path: Path) -> Iterator[str]:
+    """Décode un fichier texte par morceaux.
+
+    Le texte est lu en UTF-8 ; au premier octet invalide, la suite du fichier
+    est décodée avec l'encodage détecté sur un échantillon, sinon en Latin-1.
+    """
+    decoder: codecs.IncrementalDecoder = codecs.getincrementaldecoder("utf-8")()
+    for block in read_blocks(path):
+        try:
+            yield decoder.decode(block)
+        except UnicodeDecodeError:
+            # Reprise au début du bloc, octets en attente du décodeur compris
+            pending = decoder.getstate()[0]
+            block = pending + block
+            encoding = detect_encoding(block[:SAMPLE_SIZE])
+            decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+            yield decoder.decode(block)
+    yield decoder.decode(b"", final=True)
+
+
+def extract_email(path: Path) -> str:
+    """Sujet et parties texte d'un courriel (balises retirées des parties HTML)."""
+    with open(path, "rb") as f:
+        message = email.message_from_binary_file(f, policy=email.policy.default)
+    texts = [str(message.get("subject", ""))]
+    for part in message.walk():
+        content_type = part.get_content_type()
+        if content_type not in ("text/plain", "text/html"):
+            continue
+        payload = part.get_payload(decode=True)
+        if not isinstance(payload, bytes):
+            payload = b""
+        charset = part.get_content_charset()
+        try:
+            text = payload.decode(charset) if charset else decode(payload)
+        except (LookupError, UnicodeDecodeError):
+            text = decode(payload)
+        if content_type == "text/html":
+            text = re.sub(r"<[^>]*>", " ", text)
+        texts.append(text)
+    return "\n".join(texts)
+
+
+def extract_textract(path: Path) -> str:
+    return textract.process(path).decode("utf-8")
+
+
+# Un extracteur renvoie le texte d'un fichier, d'un bloc ou en morceaux successifs.
+EXTRACTORS: dict[str, Callable[[Path], str | Iterable[str]]] = {
+    **{extension: extract_textract for extension in EXTENSIONS},
+    **{extension: extract_text for extension in TEXT_EXTENSIONS},
+    ".eml": extract_email,
+}
+
+
+def register(extensions: set[str], extractor: Callable[[Path], Iterable[str]]) -> None:
+    """Associe un extracteur à des extensions."""
+    for extension in extensions:
+        EXTRACTORS[extension] = extractor
+
+
+def get_extractor(path: Path) -> Callable[[Path], str | Iterable[str]]:
+    # Les fichiers sans extension connue (courriels Enron, etc.) sont du texte
+    return EXTRACTORS.get(path.suffix.lower(), extract_text)
+
+
+def extract(path: Path) -> Iterator[str]:
+    """Texte d'un fichier, avec mesure du temps passé par extracteur."""
+    extractor = get_extractor(path)
+    seconds = 0.0
+    try:
+        # Un extracteur d'un bloc fait tout son travail dans cet appel
+        start = monotonic()
+        try:
+            text = extractor(path)
+        finally:
+            seconds += monotonic() - start
+        chunks = iter([text] if isinstance(text, str) else text)
+        while True:
+            start = monotonic()
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                break
+            finally:
+                seconds += monotonic() - start
+            yield chunk
+    finally:
+        with stats_lock:
+            stats = extraction_stats.setdefault(
+                extractor.__name__, {"files": 0, "seconds": 0.0}
+            )
+            stats["files"] += 1
+            stats["seconds"] += seconds
+
+
+def get_stemmer() -> Stemmer.Stemmer:
+    if not hasattr(local, "stemmer"):
+        local.stemmer = Stemmer.Stemmer("english")
+    return local.stemmer
+
+
+class StemCache:
+    """Cache borné `mot brut en minuscules -> stems`, partagé entre fichiers.
+
+    Un mot brut est translittéré en ASCII (ce qui peut le couper en plusieurs
+    mots), puis chaque partie est stemmée. Le cache est partagé par les threads
+    du processus ; une fois plein, les mots les plus anciens en sortent.
+    """
+
+    def __init__(self, max_size: int = STEM_CACHE_SIZE) -> None:
+        self.max_size: int = max_size
+        self.stems: dict[str, tuple[str, ...]] = {}
+        self.lock = threading.Lock()
+        self.hits: int = 0
+        self.misses: int = 0
+        self.calls: int = 0
+        self.seconds: float = 0.0
+
+    def stem_words(self, words: set[str]) -> set[str]:
+        """Stems d'un ensemble de mots bruts en minuscules."""
+        start = monotonic()
+        result: set[str] = set()
+        missing = []
+        for word in words:
+            stems = self.stems.get(word)
+            if stems is None:
+                missing.append(word)
+            else:
+                result.update(stems)
+
+        if missing:
+            parts = [re.findall(REGEX, unidecode(word).lower()) for word in missing]
+            unique_parts = list({part for word_parts in parts for part in word_parts})
+            stemmed = dict(zip(unique_parts, get_stemmer().stemWords(unique_parts)))
+            for word, word_parts in zip(missing, parts):
+                stems = tuple(stemmed[part] for part in word_parts)
+                result.update(stems)
+                self.put(word, stems)
+
+        with self.lock:
+            self.hits += len(words) - len(missing)
+            self.misses += len(missing)
+            self.calls += 1
+            self.seconds += monotonic() - start
+        return result
+
+    def put(self, word: str, stems: tuple[str, ...]) -> None:
+        # Les lectures se passent du verrou, pas les modifications : une
+        # éviction parcourt le dictionnaire
+        with self.lock:
+            while self.stems and len(self.stems) >= self.max_size:
+                del self.stems[next(iter(self.stems))]
+            self.stems[word] = stems
+
+    def warm(self, words: Iterable[str]) -> None:
+        self.stem_words({word.lower() for word in words})
+
+    def load(self, path: Path) -> None:
+        """Préchauffe le cache avec un vocabulaire (un mot par ligne)."""
+        try:
+            with open(path, encoding="utf-8") as f:
+                self.warm(line.strip() for line in f)
+        except FileNotFoundError:
+            return
+        console.log(f"Stem cache warmed with {len(self.stems):,d} words.")
+
+    def save(self, path: Path) -> None:
+        """Enregistre le vocabulaire du cache, pour un prochain préchauffage."""
+        with self.lock:
+            words = list(self.stems)
+        content = "".join(f"{word}\n" for word in words)
+        crypt.write_atomic(path, content.encode("utf-8"))
+
+    def stats(self) -> str:
+        total = self.hits + self.misses
+        ratio = self.hits / total if total else 0.0
+        cost = self.seconds / self.calls * 1e6 if self.calls else 0.0
+        return (
+            f"Stems: {ratio:.0%} cached, {len(self.stems):,d} words, "
+            f"{cost:.0f} µs per call."
+        )
+
+
+stem_cache = StemCache()
+
+
+@overload
+def stem(words: str) -> str:
+    ...
+
+
+@overload
+def stem(words: list[str]) -> set[str]:
+    ...
+
+
 def stem(words: str | list[str]) -> str | set[str]:
     """Calcule le stem d'un mot."""
     if isinstance(words, str):
-        return stemmer.stemWord(words.lower())
-    return set(stemmer.stemWords(words))
+        return get_stemmer().stemWord(unidecode(words).lower())
+    return stem_cache.stem_words({word.lower() for word in words})
+
+
+def tokenize(chunks: Iterable[str]) -> set[str]:
+    """Stems distincts d'un texte découpé en morceaux.
+
+    Seul l'ensemble des stems est conservé : la mémoire utilisée dépend du
+    vocabulaire et de `CHUNK_SIZE`, pas de la taille du texte. Un mot coupé en
+    fin de morceau est reporté au début du suivant. Les mots sont dédoublonnés
+    avant translittération et stemming.
+    """
+    stems: set[str] = set()
+    carry = ""
+    for chunk in chunks:
+        for start in range(0, len(chunk), CHUNK_SIZE):
+            text = carry + chunk[start : start + CHUNK_SIZE]
+            match = TRAILING_WORD.search(text)
+            end = match.start() if match else len(text)
+            carry = text[end:]
+            words_raw = set(WORD.findall(text[:end].lower()))
+            stems.update(stem_cache.stem_words(words_raw))
+    if carry:
+        stems.update(stem_cache.stem_words({carry.lower()}))
+    return stems
 
 
 def index_file(path: Path, min_length: int = 2) -> set[str]:
@@ -61,28 +343,8 @@ def index_file(path: Path, min_length: int = 2) -> set[str]:
         path: Chemin vers le fichier
         min_length: Longueur minimale d'un mots
     """
-    index = set()
-    extension = path.suffix
-    if extension in EXTENSIONS:
-        try:
-            text = textract.process(path)
-        except Exception as e:
-            console.error(e)
-            return set()
-    else:
-        try:
-            text = textract.process(path, extension="txt")
-        except ExtensionNotSupported as e:
-            console.error(e)
-            return set()
-        except Exception as e:
-            console.error(e)
-            return set()
-
-    text = text.decode("utf-8")
-    clean_text = unidecode(text.strip())
-
-    words_raw = re.findall(REGEX, clean_text)
-    stem_tokens = stem(words_raw)
-    index.update(stem_tokens)
-    return index
+    try:
+        return tokenize(extract(path))
+    except Exception as e:
+        console.error(e)
+        return set()
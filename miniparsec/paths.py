@@ -2,3 +2,6 @@ from pathlib import Path
 
 CLIENT_ROOT = Path("data/client")
 SERVER_ROOT = Path("data/server")
+
+# Verrou du serveur et de la fusion, hors de SERVER_ROOT (vidé par un reset)
+LOCK_PATH = Path("data/server.lock")
@@ -0,0 +1,60 @@
+"""Opérations sur des listes triées de documents, pour les requêtes multiples."""
+
+import heapq
+from bisect import bisect_left
+from collections.abc import Iterable
+
+# Rapport de tailles au-delà duquel l'intersection procède par dichotomie.
+GALLOP_RATIO = 8
+
+
+def order(document: int | str) -> tuple[bool, int | str]:
+    """Clé de tri : les identifiants, puis les chemins d'un ancien format."""
+    return isinstance(document, str), document
+
+
+def sort(documents: Iterable[int | str]) -> list[int | str]:
+    return sorted(documents, key=order)
+
+
+def intersect(a: list[int | str], b: list[int | str]) -> list[int | str]:
+    """Intersection de deux listes triées."""
+    if len(a) > len(b):
+        a, b = b, a
+    result: list[int | str] = []
+    if not a:
+        return result
+
+    # Liste courte face à une liste longue : recherche dichotomique
+    if len(b) > GALLOP_RATIO * len(a):
+        position = 0
+        for document in a:
+            position = bisect_left(b, order(document), position, key=order)
+            if position == len(b):
+                break
+            if b[position] == document:
+                result.append(document)
+        return result
+
+    # Tailles comparables : parcours simultané
+    i, j = 0, 0
+    while i < len(a) and j < len(b):
+        key_a, key_b = order(a[i]), order(b[j])
+        if key_a == key_b:
+            result.append(a[i])
+            i += 1
+            j += 1
+        elif key_a < key_b:
+            i += 1
+        else:
+            j += 1
+    return result
+
+
+def union(lists: Iterable[list[int | str]]) -> list[int | str]:
+    """Union de listes triées, par fusion à k voies."""
+    result: list[int | str] = []
+    for document in heapq.merge(*lists, key=order):
+        if not result or result[-1] != document:
+            result.append(document)
+    return result
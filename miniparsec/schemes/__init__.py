@@ -1,6 +1,7 @@
 """Init."""
 
 from . import scheme
+from .diana import Diana
 from .pibas import PiBas
 from .pibasdyn import PiBasDyn
 from .pibasplus import PiBasPlus
@@ -10,6 +11,7 @@ from .sophos import Sophos
 
 __all__ = [
     "scheme",
+    "Diana",
     "PiBas",
     "PiBasDyn",
     "PiBasPlus",
@@ -0,0 +1,167 @@
+import hashlib
+from pathlib import Path
+
+from psycopg import Connection
+from psycopg_pool import ConnectionPool
+
+from miniparsec import crypt, index
+from miniparsec.paths import CLIENT_ROOT
+from miniparsec.state import CounterStore
+from miniparsec.storage import Storage
+from miniparsec.tokens import DianaToken
+from miniparsec.utils import console
+
+from .scheme import Scheme
+
+# Profondeur de l'arbre GGM : au plus 2^DEPTH entrées par mot.
+DEPTH = 24
+
+
+def ggm_child(node: bytes, bit: int) -> bytes:
+    """Fils gauche (0) ou droit (1) d'un nœud de l'arbre GGM."""
+    return hashlib.blake2b(bytes((bit,)), key=node, digest_size=32).digest()
+
+
+def ggm_leaf(root: bytes, leaf: int, depth: int = DEPTH) -> bytes:
+    node = root
+    for level in reversed(range(depth)):
+        node = ggm_child(node, (leaf >> level) & 1)
+    return node
+
+
+def ggm_cover(root: bytes, count: int, depth: int = DEPTH) -> list[tuple[int, bytes]]:
+    """Clé contrainte aux feuilles `[0, count)` : au plus `depth` sous-arbres.
+
+    Returns:
+        Couples (hauteur du sous-arbre, nœud racine), de gauche à droite.
+    """
+    nodes = []
+    node = root
+    for level in reversed(range(depth)):
+        if (count >> level) & 1:
+            nodes.append((level, ggm_child(node, 0)))
+            node = ggm_child(node, 1)
+        else:
+            node = ggm_child(node, 0)
+    return nodes
+
+
+def ggm_expand(nodes: list[tuple[int, bytes]]) -> list[bytes]:
+    """Feuilles couvertes par une clé contrainte, dans l'ordre."""
+    leaves = []
+    for height, node in nodes:
+        level = [node]
+        for _ in range(height):
+            level = [ggm_child(parent, bit) for parent in level for bit in (0, 1)]
+        leaves += level
+    return leaves
+
+
+class Diana(Scheme):
+    """Schéma Diana (Bost, Minaud, Ohrimenko, 2017), à confidentialité persistante.
+
+    La `c`-ième entrée d'un mot est dérivée de la `c`-ième feuille `ST_c` d'un
+    arbre GGM propre au mot : un ajout ne coûte que `DEPTH` hachages, sans
+    cryptographie asymétrique. Le client ne garde que le compteur du mot. Une
+    recherche envoie une clé contrainte aux feuilles déjà utilisées (au plus
+    `DEPTH` nœuds) ; le serveur la développe en clés d'entrées, récupérées en
+    requêtes groupées. Les feuilles suivantes restent imprévisibles pour le
+    serveur, d'où la confidentialité persistante.
+    """
+
+    def __init__(
+        self, key: bytes, storage: Storage | Connection | ConnectionPool
+    ) -> None:
+        super().__init__(key, storage)
+        self.tables_names: set[str] = {"diana"}
+        self.counts_store: CounterStore = CounterStore("diana_count", key)
+
+    def reset(self) -> None:
+        super().reset()
+        self.storage.create("diana")
+        self.counts_store.clear()
+
+    def word_keys(self, word: str) -> tuple[bytes, bytes]:
+        """Racine de l'arbre GGM du mot, et clé de hachage de ses entrées."""
+        root, kw = crypt.hmac_many([f"diana1{word}", f"diana2{word}"], self.key)
+        return root, kw
+
+    def tokenize(self, word: str, prefix: str = "") -> DianaToken:
+        del prefix
+        root, kw = self.word_keys(word)
+        return DianaToken(kw, ggm_cover(root, self.get_count(word)))
+
+    def get_count(self, word: str) -> int:
+        return self.counts_store.get(word, 0)
+
+    def estimate(self, word: str) -> int | None:
+        return self.get_count(index.stem(word))
+
+    def prepare_file_words(
+        self, client_path: Path, words: set[str]
+    ) -> dict[str, list[tuple[bytes, bytes]]]:
+        with self.lock:
+            # Tous les mots sont vérifiés avant de réserver quoi que ce soit
+            reserved = [(word, self.counts_store.get(word, 0)) for word in words]
+            count = max((count for _, count in reserved), default=0)
+            if count >= 2**DEPTH:
+                raise ValueError(f"Too many entries for a word ({count}).")
+            doc_id = self.documents.add(str(client_path.relative_to(CLIENT_ROOT)))
+            for word, count in reserved:
+                self.counts_store[word] = count + 1
+            if self.cache is not None:
+                self.cache.invalidate(words)
+
+        rows = []
+        for word, count in reserved:
+            root, kw = self.word_keys(word)
+            leaf = ggm_leaf(root, count)
+            ut, mask = crypt.hmac_many([b"1" + leaf, b"2" + leaf], kw)
+            value = doc_id ^ int(mask[:8], 16)
+            rows.append((ut, value.to_bytes(4, "little")))
+        return {"diana": rows}
+
+    def write_entries(self, rows: dict[str, list[tuple[bytes, bytes]]]) -> None:
+        with self.lock:
+            self.documents.flush()
+        for table_name, table_rows in rows.items():
+            self.storage.put_many(table_name, table_rows)
+        with self.lock:
+            self.counts_store.flush()
+
+    def add_file_words(self, client_path: Path, verbose=True) -> int:
+        return self.add_files_words([client_path], verbose=verbose)
+
+    def search_token(  # type: ignore[override]
+        self, token: DianaToken, table_name: str
+    ) -> set[int | str]:
+        """Développement de la clé contrainte, côté serveur."""
+        leaves = ggm_expand(token.nodes)
+        contents = [prefix + leaf for leaf in leaves for prefix in (b"1", b"2")]
+        keys = crypt.hmac_many(contents, token.kw)
+        masks = {ut: int(mask[:8], 16) for ut, mask in zip(keys[::2], keys[1::2])}
+
+        found = self.storage.get_many(table_name, list(masks))
+        result: set[int | str] = set()
+        for ut, values in found.items():
+            for value in values:
+                result.add(int.from_bytes(value, "little") ^ masks[ut])
+        return result
+
+    def search_word(self, word: str) -> set[int | str]:
+        word = index.stem(word)
+        count = self.get_count(word)
+        if not count:
+            return set()
+
+        if self.cache is not None:
+            cached = self.cache.get(word, count)
+            if cached is not None:
+                console.log(f"{len(cached)} results in cache.")
+                return set(cached)
+
+        results = self.search_token(self.tokenize(word), "diana")
+        console.log(f"{len(results)} results in table diana.")
+        if self.cache is not None:
+            self.cache.put(word, count, list(results))
+        return results
@@ -1,76 +1,251 @@
-from psycopg import Connection, sql
+import asyncio
 
-from miniparsec import crypt, databases, index
+from psycopg import Connection
+from psycopg_pool import ConnectionPool
+
+from miniparsec import crypt, entries, index, query
+from miniparsec.storage import Storage
 from miniparsec.tokens import PiToken
 from miniparsec.utils import console
 
 from .scheme import Scheme
 
+# Taille maximale d'une fenêtre de sondage.
+BATCH_SIZE = 1000
+
+# Taille de la première fenêtre de sondage quand le compteur est inconnu.
+PROBE_WINDOW = 16
+
 
 class PiBas(Scheme):
-    def __init__(self, key: bytes, conn: Connection) -> None:
-        super().__init__(key, conn)
+    def __init__(
+        self, key: bytes, storage: Storage | Connection | ConnectionPool
+    ) -> None:
+        super().__init__(key, storage)
         self.tables_names: set[str] = {"edb"}
 
     def reset(self):
         super().reset()
         for table_name in self.tables_names:
-            databases.drop_table(self.conn, table_name)
-            databases.create_table(
-                self.conn, table_name, {"token": "bytea", "file": "bytea"}
-            )
-            databases.create_index(self.conn, table_name)
+            self.storage.create(table_name)
 
     def tokenize(self, word: str, prefix: str = "", key: bytes = b"") -> PiToken:
+        return self.tokenize_many([word], prefix, key)[0]
+
+    def tokenize_many(
+        self, words: list[str], prefix: str = "", key: bytes = b""
+    ) -> list[PiToken]:
+        """Tokens de plusieurs mots, dérivés en une passe."""
         if not key:
             key = self.key
-        return PiToken(
-            crypt.hmac(f"{prefix}1{word}", key),
-            crypt.hmac(f"{prefix}2{word}", key),
-        )
+        contents = [f"{prefix}{i}{word}" for word in words for i in (1, 2)]
+        keys = crypt.hmac_many(contents, key)
+        return [PiToken(k1, k2) for k1, k2 in zip(keys[::2], keys[1::2])]
+
+    def get_count(self, word: str, table_name: str) -> int | None:
+        """Nombre d'entrées connu pour `word` dans `table_name` (None si inconnu)."""
+        del word, table_name
+        return None
+
+    def estimate(self, word: str) -> int | None:
+        word = index.stem(word)
+        total = 0
+        for table_name in self.tables_names:
+            count = self.get_count(word, table_name)
+            if count is None:
+                return None
+            total += count * self.pack_size(table_name)
+        return total
+
+    def pack_size(self, table_name: str) -> int:
+        """Nombre maximal de documents par entrée de `table_name`."""
+        del table_name
+        return 1
 
-    def search_token(
+    def fetch_entries(self, table_name: str, keys: list[bytes]) -> dict[bytes, list]:
+        """Récupère les entrées de plusieurs clés en requêtes groupées."""
+        if not keys:
+            return {}
+        return self.storage.get_many(table_name, keys)
+
+    def decrypt_entries(self, token: PiToken, values: list) -> set[int | str]:
+        """Documents d'un ensemble d'entrées chiffrées.
+
+        Les chemins d'un ancien format sont remplacés par leur identifiant
+        lorsqu'il est connu.
+        """
+        result: set[int | str] = set()
+        for value in values:
+            query_result = crypt.decrypt(value, key=token.k2)
+            documents = entries.decode(query_result)
+            if documents and isinstance(documents[0], str):
+                for path in documents:
+                    doc_id = self.documents.get_id(path)
+                    result.add(path if doc_id is None else doc_id)
+            else:
+                result.update(documents)
+        return result
+
+    def search_token(  # type: ignore[override]
         self,
         token: PiToken,
         table_name: str,
         count: int = 0,
         max_count: int | None = None,
-    ) -> set[str]:
-        cursor = self.conn.cursor()
-        result = set()
+    ) -> set[int | str]:
+        result: set[int | str] = set()
 
         # Pour une seule query
         if count:
             max_count = count + 1
 
-        # Tant au'on ne dépasse pas `max_count` ou que Postgres ne renvoie pas None
-        while max_count is None or count < max_count:
-            query = sql.SQL("SELECT file FROM {} WHERE token = %s;").format(
-                sql.Identifier(table_name)
-            )
-            query_key = crypt.hmac(str(count), token.k1)
-            data = (query_key,)
-            cursor.execute(query, data)
-            fetchone = cursor.fetchone()
-            if fetchone is None:
+        # Compteur connu : toutes les clés sont dérivées d'avance
+        if max_count is not None:
+            keys = crypt.counter_keys(token.k1, count, max_count)
+            found = self.fetch_entries(table_name, keys)
+            for values in found.values():
+                result.update(self.decrypt_entries(token, values))
+            return result
+
+        # Compteur inconnu : sondage par fenêtres de taille croissante, jusqu'à
+        # la première clé absente
+        window = PROBE_WINDOW
+        while True:
+            keys = crypt.counter_keys(token.k1, count, count + window)
+            found = self.fetch_entries(table_name, keys)
+            for values in found.values():
+                result.update(self.decrypt_entries(token, values))
+            if len(found) < len(keys):
                 break
-            query_result = crypt.decrypt(fetchone[0], key=token.k2).decode("utf-8")
-            result_set: set = eval(query_result)
+            count += window
+            window = min(2 * window, BATCH_SIZE)
+        return result
 
-            for entry in result_set:
-                file = entry
-                result.add(file)
+    def cache_generation(self) -> int | None:
+        """Génération des tables (None : tables en cours de remplacement)."""
+        return 0
 
-            count += 1
-        return result
+    def counts_version(self, word: str) -> tuple[dict[str, int | None], tuple | None]:
+        """Compteurs du mot par table, et version de son entrée du cache.
+
+        La version associe les compteurs à la génération des tables, lue avant
+        eux : les compteurs d'une table tampon repartent de zéro à chaque
+        fusion, et ne datent pas seuls les résultats (None : pas de cache).
+        """
+        generation = self.cache_generation() if self.cache is not None else None
+        counts = {name: self.get_count(word, name) for name in self.tables_names}
+        version = None
+        if generation is not None and None not in counts.values():
+            version = (generation, *sorted(counts.items()))
+        return counts, version
+
+    def cacheable(self, version: tuple | None) -> bool:
+        """Résultats à garder : aucune publication pendant la recherche."""
+        return version is not None and self.cache_generation() == version[0]
 
-    def search_word(self, word: str) -> set[str]:
-        results = set()
+    def search_word(self, word: str) -> set[int | str]:
         word = index.stem(word)
+        counts, version = self.counts_version(word)
+        if self.cache is not None and version is not None:
+            cached = self.cache.get(word, version)
+            if cached is not None:
+                console.log(f"{len(cached)} results in cache.")
+                return set(cached)
+
+        results: set[int | str] = set()
         for table_name in self.tables_names:
             token = self.tokenize(word, prefix=table_name)
-            table_results = self.search_token(token, table_name)
+            max_count = counts[table_name]
+            table_results = self.search_token(token, table_name, max_count=max_count)
+            console.log(f"{len(table_results)} results in table {table_name}.")
+            results.update(table_results)
+
+        if self.cache is not None and self.cacheable(version):
+            self.cache.put(word, version, list(results))
+        return results
+
+    async def fetch_entries_async(
+        self, table_name: str, keys: list[bytes]
+    ) -> dict[bytes, list]:
+        if not keys:
+            return {}
+        return await self.storage.get_many_async(table_name, keys)
+
+    async def search_token_async(
+        self, token: PiToken, table_name: str, max_count: int | None = None
+    ) -> set[int | str]:
+        """Variante asynchrone de `search_token`."""
+        result: set[int | str] = set()
+        if max_count == 0:
+            return result
+
+        if max_count is not None:
+            keys = crypt.counter_keys(token.k1, 0, max_count)
+            found = await self.fetch_entries_async(table_name, keys)
+            for values in found.values():
+                result.update(self.decrypt_entries(token, values))
+            return result
+
+        count, window = 0, PROBE_WINDOW
+        while True:
+            keys = crypt.counter_keys(token.k1, count, count + window)
+            found = await self.fetch_entries_async(table_name, keys)
+            for values in found.values():
+                result.update(self.decrypt_entries(token, values))
+            if len(found) < len(keys):
+                break
+            count += window
+            window = min(2 * window, BATCH_SIZE)
+        return result
+
+    async def search_word_async(self, word: str) -> set[int | str]:
+        """Variante asynchrone de `search_word` (tables interrogées en parallèle)."""
+        word = index.stem(word)
+        counts, version = self.counts_version(word)
+        if self.cache is not None and version is not None:
+            cached = self.cache.get(word, version)
+            if cached is not None:
+                return set(cached)
+
+        tables_names = list(self.tables_names)
+        tables_results = await asyncio.gather(
+            *(
+                self.search_token_async(
+                    self.tokenize(word, prefix=table_name),
+                    table_name,
+                    max_count=counts[table_name],
+                )
+                for table_name in tables_names
+            )
+        )
+        results: set[int | str] = set()
+        for table_name, table_results in zip(tables_names, tables_results):
             console.log(f"{len(table_results)} results in table {table_name}.")
             results.update(table_results)
 
+        if self.cache is not None and self.cacheable(version):
+            self.cache.put(word, version, list(results))
         return results
+
+    async def search_intersection_async(self, words: list[str]) -> set[int | str]:
+        """Intersection, avec les recherches de tous les mots lancées simultanément."""
+        words = self.plan(words)
+        if any(self.estimate(word) == 0 for word in words):
+            return set()
+        sets = await asyncio.gather(*(self.search_word_async(word) for word in words))
+        result: list[int | str] | None = None
+        for documents in sorted(sets, key=len):
+            sorted_documents = query.sort(documents)
+            if result is None:
+                result = sorted_documents
+            else:
+                result = query.intersect(result, sorted_documents)
+            if not result:
+                break
+        return set(result or ())
+
+    async def search_union_async(self, words: list[str]) -> set[int | str]:
+        sets = await asyncio.gather(
+            *(self.search_word_async(word) for word in set(words))
+        )
+        return set(query.union([query.sort(documents) for documents in sets]))
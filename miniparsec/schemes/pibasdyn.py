@@ -1,5 +1,148 @@
+import asyncio
+from pathlib import Path
+
+from psycopg import Connection
+from psycopg_pool import ConnectionPool
+
+from miniparsec import crypt
+from miniparsec.paths import CLIENT_ROOT
+from miniparsec.storage import Storage
+from miniparsec.utils import console, file
+
 from .pibasplus import PiBasPlus
 
+# Part des documents révoqués au-delà de laquelle une fusion réécrit EDB.
+REVOKED_REWRITE = 0.1
+
 
 class PiBasDyn(PiBasPlus):
-    pass
+    """PiBasPlus avec suppression, par révocation des documents.
+
+    Retirer des fichiers ajoute une ligne par document à une table chiffrée
+    `revoked` (clé dérivée de l'identifiant, valeur chiffrée), en une écriture,
+    sans toucher aux entrées des mots. Les résultats d'une recherche sont
+    filtrés en une requête groupée sur cette table. Une fois `revoked_rewrite`
+    des documents révoqués (ou si EDB est de toute façon reconstruite), la
+    fusion réécrit EDB sans eux, puis retire leurs lignes de la table.
+    """
+
+    def __init__(
+        self, key: bytes, storage: Storage | Connection | ConnectionPool, B: int = 1
+    ):
+        super().__init__(key, storage)
+        self.B = B
+        # Table `revoked` vue (absente d'une installation antérieure)
+        self.revocable: bool = False
+        self.revoked_rewrite: float = REVOKED_REWRITE
+
+    def reset(self):
+        super().reset()
+        self.storage.create("revoked")
+        self.revocable = True
+
+    def has_revoked(self) -> bool:
+        """La table `revoked` existe : elle n'est créée qu'au premier retrait."""
+        if not self.revocable:
+            self.revocable = self.storage.exists("revoked")
+        return self.revocable
+
+    def revoke_keys(self, documents: list[int]) -> list[bytes]:
+        return crypt.hmac_many((f"revoke{doc_id}" for doc_id in documents), self.key)
+
+    def remove_files(self, client_paths: list[Path]) -> None:
+        """Révoque un lot de fichiers en une seule écriture."""
+        documents = []
+        with self.lock:
+            for client_path in client_paths:
+                doc_id = self.documents.remove(
+                    str(client_path.relative_to(CLIENT_ROOT))
+                )
+                if doc_id is not None:
+                    documents.append(doc_id)
+
+        if documents:
+            if not self.has_revoked():
+                self.storage.create("revoked")
+                self.revocable = True
+            rows = [
+                (key, crypt.encrypt(doc_id.to_bytes(4, "little"), self.key))
+                for key, doc_id in zip(self.revoke_keys(documents), documents)
+            ]
+            self.storage.put_many("revoked", rows)
+        with self.lock:
+            self.documents.flush()
+
+        for client_path in client_paths:
+            file.delete(file.get_server_path(client_path), verbose=False)
+        console.log(f"Revoked {len(documents)} documents.")
+
+    def remove_file(self, client_path: Path) -> None:
+        self.remove_files([client_path])
+
+    def drop_revoked(
+        self, documents: set[int | str], keys: dict[bytes, int], found: dict
+    ) -> set[int | str]:
+        if found:
+            console.log(f"{len(found)} revoked results filtered.")
+        return documents - {keys[key] for key in found}
+
+    def filter_revoked(self, documents: set[int | str]) -> set[int | str]:
+        """Retire des résultats les documents révoqués, en requêtes groupées."""
+        ids = [document for document in documents if isinstance(document, int)]
+        if not ids or not self.has_revoked():
+            return documents
+        keys = dict(zip(self.revoke_keys(ids), ids))
+        found = self.storage.get_many("revoked", list(keys))
+        return self.drop_revoked(documents, keys, found)
+
+    async def filter_revoked_async(self, documents: set[int | str]) -> set[int | str]:
+        ids = [document for document in documents if isinstance(document, int)]
+        if not ids or not await asyncio.to_thread(self.has_revoked):
+            return documents
+        keys = dict(zip(self.revoke_keys(ids), ids))
+        found = await self.storage.get_many_async("revoked", list(keys))
+        return self.drop_revoked(documents, keys, found)
+
+    def search_word(self, word: str) -> set[int | str]:
+        return self.filter_revoked(super().search_word(word))
+
+    async def search_word_async(self, word: str) -> set[int | str]:
+        return await self.filter_revoked_async(await super().search_word_async(word))
+
+    def revoked_documents(self) -> set[int]:
+        if not self.has_revoked():
+            return set()
+        return {
+            int.from_bytes(crypt.decrypt(value, self.key), "little")
+            for _, value in self.storage.scan("revoked")
+        }
+
+    def begin_merge(self) -> None:
+        if not self.staging_empty:
+            # La nouvelle table tampon a gardé des entrées d'avant la bascule :
+            # les révocations attendent que les deux tables soient fusionnées
+            self.dropped = set()
+            return
+        # Les documents ajoutés après la bascule peuvent avoir des entrées dans
+        # la nouvelle table tampon : leur révocation attend la fusion suivante
+        revoked = {
+            doc_id
+            for doc_id in self.revoked_documents()
+            if doc_id < self.frozen_documents
+        }
+        # Réécrire EDB coûte sa taille entière : en dessous du seuil, les
+        # révocations restent filtrées à la recherche
+        threshold = self.revoked_rewrite * self.frozen_documents
+        if not revoked or (len(revoked) < threshold and not self.rewriting()):
+            self.dropped = set()
+            return
+        self.dropped = revoked
+        self.rewrite = True
+        console.log(f"Dropping {len(self.dropped)} revoked documents.")
+
+    def end_merge(self) -> None:
+        if self.dropped:
+            keys = self.revoke_keys(sorted(self.dropped))
+            self.storage.delete_many("revoked", keys)
+        self.rewrite = False
+        self.dropped = set()
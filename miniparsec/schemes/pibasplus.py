@@ -1,134 +1,588 @@
+import asyncio
+import threading
+from collections.abc import Iterator
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ProcessPoolExecutor,
+    as_completed,
+    wait,
+)
+from contextlib import ExitStack, contextmanager
 from pathlib import Path
+from time import monotonic
 
-from psycopg import Connection, sql
+from psycopg import Connection
+from psycopg_pool import ConnectionPool
 from rich.progress import Progress
 
-from miniparsec import crypt, databases, index
+from miniparsec import crypt, entries
 from miniparsec.paths import CLIENT_ROOT, SERVER_ROOT
-from miniparsec.utils import console, file, timing
+from miniparsec.state import CounterStore
+from miniparsec.storage import Storage
+from miniparsec.tokens import PiToken
+from miniparsec.utils import console
 
 from .pibas import PiBas
 
+# Plafond par défaut des ciphertexts lus par lot de fusion, en octets.
+MERGE_MEMORY = 64 * 2**20
 
-class PiBasPlus(PiBas):
-    def __init__(self, key: bytes, conn: Connection) -> None:
-        super().__init__(key, conn)
-        self.tables_names: set[str] = {"edb", "edb2"}
-        self.protected_filenames = {"edb_count.pkl", "edb2_count.pkl"}
+# Nombre maximal de mots par lot de fusion.
+MERGE_BATCH_WORDS = 1000
 
-    def reset(self):
-        super().reset()
+# Estimation initiale de la taille d'une entrée, avant mesure.
+ROW_BYTES = 128
 
-    def add_word_helper(
-        self, word: str, count: int, filename: str, table_name: str
+# Fichier de la génération des tables publiées (dans SERVER_ROOT).
+GENERATION_FILE = "generation"
+
+# Fichier du nom de la table tampon courante (dans SERVER_ROOT).
+STAGING_FILE = "staging"
+
+# Attente maximale de la fin d'une publication, et intervalle de relecture de
+# la génération écrite par un autre processus, en secondes.
+PUBLISH_TIMEOUT = 60.0
+GENERATION_POLL = 0.05
+
+
+class PiBasPlus(PiBas):
+    def __init__(
+        self, key: bytes, storage: Storage | Connection | ConnectionPool
     ) -> None:
-        cursor = self.conn.cursor()
+        super().__init__(key, storage)
+        self.tables_names: set[str] = {"edb", "edb2", "edb3"}
+        self.edb_count: CounterStore = CounterStore("edb_count", key)
+        self.edb2_count: CounterStore = CounterStore("edb2_count", key)
+        self.edb3_count: CounterStore = CounterStore("edb3_count", key)
+        # Deux tables tampons alternent : les ajouts vont dans `staging` pendant
+        # que l'autre est fusionnée (`source`). La table courante est enregistrée
+        # avec les compteurs, et relue au premier accès (None : pas encore lue)
+        self.saved_staging: str | None = None
+        self.source: str = "edb2"
+        self.frozen_documents: int = 0
+        # La nouvelle table tampon était vide lors de la dernière bascule
+        self.staging_empty: bool = True
+        # Génération à laquelle les compteurs ont été lus (None : jamais)
+        self.seen_generation: int | None = None
+        # Entrées réservées mais pas encore écrites, par table tampon
+        self.unwritten: dict[str, int] = {"edb2": 0, "edb3": 0}
+        # Entrées et mots de la table tampon courante (None : à recompter)
+        self.staged: tuple[int, int] | None = None
+        self.written: threading.Condition = threading.Condition(self.lock)
+        self.B: int = 1
+        self.merge_memory: int = MERGE_MEMORY
+        self.merge_batch_words: int = MERGE_BATCH_WORDS
+        self.merge_workers: int = 1
+        # Fusion complète demandée, et documents à écarter lors de la fusion
+        self.rewrite: bool = False
+        self.dropped: set[int] = set()
+
+    def __getstate__(self) -> dict:
+        state = super().__getstate__()
+        state.update(written=None)
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        super().__setstate__(state)
+        self.written = threading.Condition(self.lock)
 
+    def reset(self):
+        super().reset()
+        self.edb_count.clear()
+        self.edb2_count.clear()
+        self.edb3_count.clear()
+        self.staging = "edb2"
+        self.staged = (0, 0)
+
+    @property
+    def staging(self) -> str:
+        """Table tampon qui reçoit les ajouts."""
+        if self.saved_staging is None:
+            try:
+                table_name = (SERVER_ROOT / STAGING_FILE).read_text()
+            except FileNotFoundError:
+                table_name = "edb2"
+            # Installation antérieure au fichier : edb2 était toujours la table
+            self.saved_staging = table_name if table_name == "edb3" else "edb2"
+        return self.saved_staging
+
+    @staging.setter
+    def staging(self, table_name: str) -> None:
+        crypt.write_atomic(SERVER_ROOT / STAGING_FILE, table_name.encode())
+        self.saved_staging = table_name
+
+    def get_count(self, word: str, table_name: str) -> int | None:
+        counts: CounterStore = getattr(self, f"{table_name}_count")
+        if not counts.exists():
+            # Les compteurs d'une table tampon précèdent ses entrées : sans
+            # eux, elle est vide (voire absente, dans une installation
+            # antérieure à EDB3)
+            return None if table_name == "edb" else 0
+        return counts.get(word, 0)
+
+    def pack_size(self, table_name: str) -> int:
+        return self.B if table_name == "edb" else 1
+
+    def make_entry(
+        self, word: str, count: int, entry: bytes, table_name: str
+    ) -> tuple[bytes, bytes]:
+        """Calcule la ligne (token, file) de la `count`-ième entrée de `word`."""
+        return self.make_entries([(word, count, entry)], table_name)[0]
+
+    def make_entries(
+        self, items: list[tuple[str, int, bytes]], table_name: str
+    ) -> list[tuple[bytes, bytes]]:
+        """Calcule les lignes (token, file) d'entrées `(mot, numéro, entrée)`.
+
+        Les tokens sont dérivés une seule fois par mot, en une passe.
+        """
         key = self.key if self.newkey is None else self.newkey
-        token = self.tokenize(word, prefix=table_name, key=key)
+        words = list(dict.fromkeys(word for word, _, _ in items))
+        tokens = dict(zip(words, self.tokenize_many(words, table_name, key)))
 
-        query = sql.SQL("INSERT INTO {} VALUES (%s, %s)").format(
-            sql.Identifier(table_name)
-        )
+        rows = []
+        for word, count, entry in items:
+            token = tokens[word]
+            entry_key = crypt.hmac(str(count), key=token.k1)
+            entry_value = crypt.encrypt(entry, key=token.k2)
+            rows.append((entry_key, entry_value))
+        return rows
 
-        entry_key = crypt.hmac(str(count), key=token.k1)
-        entry_value = crypt.encrypt(filename, key=token.k2)
-        data = (entry_key, entry_value)
-
-        cursor.execute(query, data)
+    def add_word_helper(
+        self, word: str, count: int, entry: bytes, table_name: str
+    ) -> None:
+        data = self.make_entry(word, count, entry, table_name)
+        self.storage.put_many(table_name, [data])
 
     def add_word(self, word: str, client_path: Path) -> None:
-        edb2_count: dict[str, int] = crypt.decrypt_pickle("edb2_count", self.key, {})
-        count = edb2_count.get(word, 0)
+        with self.lock:
+            table_name = self.staging
+            counts: CounterStore = getattr(self, f"{table_name}_count")
+            count = counts.get(word, 0)
+
+            doc_id = self.documents.add(str(client_path.relative_to(CLIENT_ROOT)))
+            self.documents.flush()
+            entry = entries.encode_ids([doc_id])
+            self.add_word_helper(word, count, entry, table_name)
+
+            counts[word] = count + 1
+            counts.flush()
+            self.add_staged(1, 0 if count else 1)
+            if self.cache is not None:
+                self.cache.invalidate((word,))
 
-        filename = str(client_path.relative_to(CLIENT_ROOT))
-        self.add_word_helper(word, count, filename, "edb2")
+    def add_file_words(self, client_path: Path, verbose=True) -> int:
+        return self.add_files_words([client_path], verbose=verbose)
+
+    def prepare_file_words(
+        self, client_path: Path, words: set[str]
+    ) -> dict[str, list[tuple[bytes, bytes]]]:
+        # Seule la réservation des compteurs est exclusive : le chiffrement des
+        # entrées peut se faire en parallèle
+        reserved: list[tuple[str, int]] = []
+        with self.lock:
+            table_name = self.staging
+            counts: CounterStore = getattr(self, f"{table_name}_count")
+            doc_id = self.documents.add(str(client_path.relative_to(CLIENT_ROOT)))
+            new_words = 0
+            for word in words:
+                count = counts.get(word, 0)
+                reserved.append((word, count))
+                counts[word] = count + 1
+                new_words += not count
+            self.unwritten[table_name] += len(reserved)
+            self.add_staged(len(reserved), new_words)
+            if self.cache is not None:
+                self.cache.invalidate(words)
+
+        entry = entries.encode_ids([doc_id])
+        items = [(word, count, entry) for word, count in reserved]
+        return {table_name: self.make_entries(items, table_name)}
+
+    def write_entries(self, rows: dict[str, list[tuple[bytes, bytes]]]) -> None:
+        # Les identifiants sont enregistrés avant les entrées qui y font référence.
+        # Les compteurs journalisés peuvent inclure des réservations dont les
+        # entrées sont encore en cours d'écriture : la recherche les ignore.
+        with self.lock:
+            self.documents.flush()
+        try:
+            for table_name, table_rows in rows.items():
+                self.storage.put_many(table_name, table_rows)
+        finally:
+            with self.written:
+                for table_name, table_rows in rows.items():
+                    getattr(self, f"{table_name}_count").flush()
+                    self.unwritten[table_name] -= len(table_rows)
+                self.written.notify_all()
+
+    def add_staged(self, rows: int, words: int) -> None:
+        """Ajoute des réservations aux totaux de la table tampon (sous `self.lock`)."""
+        if self.staged is not None:
+            self.staged = (self.staged[0] + rows, self.staged[1] + words)
+
+    def staging_size(self) -> tuple[int, int]:
+        # Totaux tenus à jour par les réservations : les compteurs ne sont
+        # relus qu'une fois par table tampon (vide, après une fusion)
+        with self.lock:
+            if self.staged is None:
+                counts: CounterStore = getattr(self, f"{self.staging}_count")
+                values = list(counts.values())
+                self.staged = (sum(values), len(values))
+            return self.staged
+
+    def freeze_staging(self) -> str:
+        """Bascule les ajouts sur l'autre table tampon, et renvoie l'ancienne.
+
+        Attend que les entrées déjà réservées dans l'ancienne table y soient
+        écrites : elle n'est plus modifiée ensuite.
+        """
+        with self.written:
+            frozen = self.staging
+            staging = "edb3" if frozen == "edb2" else "edb2"
+            self.ensure_staging(staging)
+            # Une fusion interrompue avant sa publication a pu laisser des
+            # entrées de documents antérieurs dans la nouvelle table
+            counts: CounterStore = getattr(self, f"{staging}_count")
+            self.staging_empty = next(counts.items(), None) is None
+            self.staging = staging
+            self.staged = None
+            # Les documents suivants n'ont d'entrées que dans la nouvelle table
+            self.frozen_documents = len(self.documents)
+            while self.unwritten[frozen]:
+                self.written.wait()
+        return frozen
+
+    def ensure_staging(self, table_name: str) -> None:
+        """Crée une table tampon qui n'a jamais servi, avec ses compteurs.
+
+        Une installation antérieure à EDB3 n'a ni la table, ni ses compteurs.
+        """
+        counts: CounterStore = getattr(self, f"{table_name}_count")
+        if not counts.exists():
+            self.storage.create(table_name)
+            counts.clear()
+
+    def read_generation(self) -> int:
+        """Génération des tables publiées, partagée entre processus.
+
+        Elle est impaire pendant la publication d'une fusion (tables et
+        compteurs remplacés ou vidés) : une recherche qui la chevauche, dans ce
+        processus ou dans un autre, recommence.
+        """
+        try:
+            return int((SERVER_ROOT / GENERATION_FILE).read_bytes())
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def write_generation(self, generation: int) -> None:
+        crypt.write_atomic(SERVER_ROOT / GENERATION_FILE, str(generation).encode())
+
+    @contextmanager
+    def publishing(self) -> Iterator[None]:
+        """Section où les tables et les compteurs visibles changent ensemble."""
+        with self.lock:
+            generation = self.read_generation()
+            # Une publication interrompue a pu laisser une génération impaire
+            generation += 2 if generation % 2 else 1
+            self.write_generation(generation)
+        try:
+            yield
+        finally:
+            with self.written:
+                self.write_generation(generation + 1)
+                self.seen_generation = generation + 1
+                self.written.notify_all()
+
+    def cache_generation(self) -> int | None:
+        generation = self.read_generation()
+        return None if generation % 2 else generation
+
+    def stable_generation(self) -> int:
+        """Génération courante, une fois la publication en cours terminée.
+
+        Une publication d'un autre processus est attendue par relectures, au
+        plus `PUBLISH_TIMEOUT` secondes (processus interrompu).
+        """
+        deadline = monotonic() + PUBLISH_TIMEOUT
+        with self.written:
+            while (generation := self.read_generation()) % 2:
+                if monotonic() > deadline:
+                    console.warning("Unfinished merge publication, searching anyway.")
+                    break
+                self.written.wait(GENERATION_POLL)
+            # Publiée par un autre processus : les compteurs lus sont périmés
+            if self.seen_generation not in (None, generation):
+                for counts in (self.edb_count, self.edb2_count, self.edb3_count):
+                    counts.reload()
+                self.saved_staging = None
+            self.seen_generation = generation
+            return generation
+
+    def search_word(self, word: str) -> set[int | str]:
+        while True:
+            generation = self.stable_generation()
+            results = super().search_word(word)
+            if self.read_generation() == generation:
+                return results
+
+    async def search_word_async(self, word: str) -> set[int | str]:
+        while True:
+            generation = await asyncio.to_thread(self.stable_generation)
+            results = await super().search_word_async(word)
+            if self.read_generation() == generation:
+                return results
+
+    def begin_merge(self) -> None:
+        """Appelée une fois la table tampon figée, avant la fusion."""
+
+    def end_merge(self) -> None:
+        """Appelée une fois la fusion terminée."""
+
+    def rewriting(self) -> bool:
+        """Fusion complète : EDB est reconstruite (re-chiffrement ou retraits)."""
+        # Une EDB statique ne se modifie pas en place : elle est toujours reconstruite
+        return self.newkey is not None or self.rewrite or self.storage.static("edb")
+
+    def merge_words(self) -> Iterator[tuple[str, int, int]]:
+        """Mots à fusionner, avec leurs compteurs dans EDB et la table tampon."""
+        source_count: CounterStore = getattr(self, f"{self.source}_count")
+        if not self.rewriting():
+            for word, count2 in source_count.items():
+                yield word, self.edb_count.get(word, 0), count2
+            return
+        # Fusion complète : tous les mots de EDB sont réécrits
+        for word, count in self.edb_count.items():
+            yield word, count, source_count.get(word, 0)
+        for word, count2 in source_count.items():
+            if word not in self.edb_count:
+                yield word, 0, count2
+
+    def merge_batch(
+        self, batch: list[tuple[str, int, int]], table_name: str
+    ) -> tuple[dict[str, int], int, int]:
+        """Fusionne un lot de mots, et écrit immédiatement les lignes produites.
+
+        Returns:
+            Nouveaux compteurs EDB des mots, nombre et taille des lignes lues.
+        """
+        rewrite = self.rewriting()
+        B = self.B
+
+        tokens: dict[str, tuple[PiToken, PiToken]] = {}
+        starts: dict[str, int] = {}
+        edb_keys: dict[bytes, str] = {}
+        edb2_keys: dict[bytes, str] = {}
+        words = [word for word, _, _ in batch]
+        edb_tokens = self.tokenize_many(words, prefix="edb")
+        edb2_tokens = self.tokenize_many(words, prefix=self.source)
+        for (word, count, count2), edb_token, edb2_token in zip(
+            batch, edb_tokens, edb2_tokens
+        ):
+            tokens[word] = (edb_token, edb2_token)
+            # Entrées de EDB à relire : toutes en cas de fusion complète, sinon
+            # seulement le dernier pack, qui peut être incomplet
+            if rewrite:
+                start = 0
+            elif B > 1 and count:
+                start = count - 1
+            else:
+                start = count
+            starts[word] = start
+            for entry_key in crypt.counter_keys(edb_token.k1, start, count):
+                edb_keys[entry_key] = word
+            for entry_key in crypt.counter_keys(edb2_token.k1, 0, count2):
+                edb2_keys[entry_key] = word
+
+        postings: dict[str, set[int | str]] = {word: set() for word, _, _ in batch}
+        read_rows, read_bytes = 0, 0
+        for source, keys in (("edb", edb_keys), (self.source, edb2_keys)):
+            found = self.fetch_entries(source, list(keys))
+            for entry_key, values in found.items():
+                word = keys[entry_key]
+                token = tokens[word][0 if source == "edb" else 1]
+                postings[word].update(self.decrypt_entries(token, values))
+                read_rows += len(values)
+                read_bytes += sum(len(value) for value in values)
+
+        items: list[tuple[str, int, bytes]] = []
+        counts: dict[str, int] = {}
+        for word, _, _ in batch:
+            postings[word].difference_update(self.dropped)
+            count = starts[word]
+            for entry in entries.pack(postings[word], B):
+                items.append((word, count, entry))
+                count += 1
+            counts[word] = count
+        rows = self.make_entries(items, "edb")
+
+        # Les lignes de la table tampon sont gardées jusqu'à la fin de la fusion :
+        # une recherche concurrente les lit tant que EDB n'est pas à jour
+        replaced = [] if rewrite else list(edb_keys)
+        self.storage.put_many(table_name, rows, replaced)
+        return counts, read_rows, read_bytes
+
+    def merge(self, max_memory: int | None = None, workers: int | None = None) -> None:
+        """Fusion d'une table tampon dans EDB, par lots de mots, à mémoire bornée.
+
+        La table tampon courante est d'abord figée : les ajouts continuent dans
+        l'autre pendant la fusion, et les recherches lisent les deux. Chaque lot
+        est lu, ré-empaqueté et écrit avant de passer au suivant ; un lot est
+        limité à `merge_batch_words` mots et à environ `max_memory` octets de
+        ciphertexts lus (répartis entre les workers). Avec plusieurs workers, le
+        vocabulaire est découpé en shards par hash du mot, et les lots de chaque
+        shard sont traités par un pool de processus, chacun avec sa propre
+        connexion.
+        """
+        if max_memory is None:
+            max_memory = self.merge_memory
+        if workers is None:
+            workers = self.merge_workers
+        if not self.storage.shared:
+            # Les tables ne sont pas accessibles depuis d'autres processus
+            workers = 1
+        newkey = self.newkey
+        if newkey is not None:
+            # Re-chiffrement (hors ligne) : les deux tables tampons sont d'abord
+            # fusionnées avec l'ancienne clé
+            self.newkey = None
+            try:
+                self.merge(max_memory, workers)
+                self.merge(max_memory, workers)
+            finally:
+                self.newkey = newkey
+
+        self.source = self.freeze_staging()
+        self.begin_merge()
+        rewrite = self.rewriting()
+
+        edb_count = self.edb_count
+        source_count: CounterStore = getattr(self, f"{self.source}_count")
+        new_count = edb_count
+
+        # Fusion complète : EDB est reconstruite à côté, puis remplacée
+        table_name = "edb"
+        if rewrite:
+            table_name = "edb_merge"
+            new_count = CounterStore("edb_count.merge", self.newkey or self.key)
+            new_count.clear()
+            self.storage.create(table_name)
+
+        console.log(f"Merging tables ({workers} workers)...")
+
+        total_rows, total_bytes, written = 0, 0, 0
+        row_bytes = ROW_BYTES * self.B  # Estimation, affinée au fil des lots
+        with Progress() as progress, ExitStack() as stack:
+            total = sum(source_count.values())
+            if rewrite:
+                total += sum(edb_count.values())
+            label = f"Merging {self.source.upper()} into EDB"
+            merge_task = progress.add_task(f"{label}...", total=total)
+
+            # Le coordinateur est le seul à modifier les compteurs
+            def update(batch: list[tuple[str, int, int]], result: tuple) -> None:
+                nonlocal total_rows, total_bytes, written, row_bytes
+                counts, read_rows, read_bytes = result
+                with self.lock:
+                    if self.cache is not None:
+                        self.cache.invalidate(counts)
+                    for word, count in counts.items():
+                        new_count[word] = count
+                    new_count.flush()
+
+                total_rows += read_rows
+                total_bytes += read_bytes
+                written += sum(counts.values())
+                if total_rows:
+                    row_bytes = total_bytes / total_rows
+                progress.update(
+                    merge_task,
+                    advance=sum(count + count2 for _, count, count2 in batch),
+                    description=f"{label} ({total_bytes:,d} bytes)...",
+                )
 
-        edb2_count[word] = count + 1
-        crypt.encrypt_pickle(edb2_count, "edb2_count", self.key)
+            running: dict[Future, list[tuple[str, int, int]]] = {}
+            executor: ProcessPoolExecutor | None = None
+            if workers > 1:
+                executor = stack.enter_context(
+                    ProcessPoolExecutor(
+                        workers, initializer=init_merge_worker, initargs=(self,)
+                    )
+                )
+
+            def submit(batch: list[tuple[str, int, int]]) -> None:
+                if executor is None:
+                    update(batch, self.merge_batch(batch, table_name))
+                    return
+                # Au plus deux lots par worker en vol, pour borner la mémoire
+                while len(running) >= 2 * workers:
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        update(running.pop(future), future.result())
+                future = executor.submit(merge_batch_worker, batch, table_name)
+                running[future] = batch
+
+            batch_memory = max_memory / workers
+            batches: list[list[tuple[str, int, int]]] = [[] for _ in range(workers)]
+            batches_bytes = [0.0] * workers
+            for word, count, count2 in self.merge_words():
+                shard = self.shard_index(word, workers)
+                batch = batches[shard]
+                word_bytes = (count + count2) * row_bytes
+                if batch and (
+                    batches_bytes[shard] + word_bytes > batch_memory
+                    or len(batch) >= self.merge_batch_words
+                ):
+                    submit(batch)
+                    batch = batches[shard] = []
+                    batches_bytes[shard] = 0.0
+                batch.append((word, count, count2))
+                batches_bytes[shard] += word_bytes
+            for batch in batches:
+                if batch:
+                    submit(batch)
+            for future in as_completed(list(running)):
+                update(running.pop(future), future.result())
+
+        # Jusqu'ici, la table tampon figée complète les lectures d'EDB
+        with self.publishing():
+            if rewrite:
+                self.storage.replace(table_name, "edb")
+                edb_count.replace(new_count)
+            self.storage.truncate(self.source)
+            source_count.clear()
+            self.end_merge()
+        if newkey is not None:
+            self.edb2_count.rekey(newkey)
+            self.edb3_count.rekey(newkey)
+            self.documents.rekey(newkey)
+            if self.cache is not None:
+                self.cache.clear(newkey)
 
-    def add_file_words(self, client_path: Path, verbose=True) -> int:
-        edb2_count: dict[str, int] = crypt.decrypt_pickle("edb2_count", self.key, {})
-
-        file_index: set[str]
-        file_index = index.index_file(client_path)
-        word_count = len(file_index)
-        index_length = len(file_index)
-        path = str(client_path.relative_to(CLIENT_ROOT))
-        path_set = set((path,))
-        for word in file_index:
-            count = edb2_count.get(word, 0)
-            self.add_word_helper(word, count, str(path_set), "edb2")
-            edb2_count[word] = count + 1
-
-        self.conn.commit()
         console.log(
-            f"Words: {word_count:6,d}, Unique words : {index_length:6,d}, edb2_count : {len(edb2_count):6,d}.",
-            verbose=verbose,
+            f"Merged {total_rows:,d} rows ({total_bytes:,d} bytes), "
+            f"wrote {written:,d} rows."
         )
-        crypt.encrypt_pickle(edb2_count, "edb2_count", self.key)
-
-        return index_length
 
-    def merge(self) -> None:
-        """Fusion de EDB et EDB2."""
+    def shard_index(self, word: str, shards: int) -> int:
+        if shards == 1:
+            return 0
+        return int(self.tokenize(word, prefix="edb").k1[:8], 16) % shards
 
-        recrypt = self.newkey is not None
 
-        edb_count: dict[str, int] = crypt.decrypt_pickle("edb_count", self.key, {})
-        edb2_count: dict[str, int] = crypt.decrypt_pickle("edb2_count", self.key, {})
-        global_index: dict[str, set[str]] = {}
+# Schéma propre à chaque processus du pool de fusion
+_worker_scheme: PiBasPlus | None = None
 
-        console.log("Merging tables...")
 
-        if recrypt:
-            with Progress() as progress:
-                total = sum(edb2_count.values())
-                load_words = progress.add_task("Loading EDB words...", total=total)
+def init_merge_worker(scheme: PiBasPlus) -> None:
+    """Initialise un worker de fusion, avec sa propre connexion."""
+    global _worker_scheme
+    scheme.storage.open_worker()
+    _worker_scheme = scheme
 
-                for word in edb_count:
-                    edb_token = self.tokenize(word, prefix="edb")
-                    max_count = edb_count[word]
-                    results = self.search_token(edb_token, "edb", max_count=max_count)
-                    edb_count[word] = 0
-                    global_index[word] = results
-                    progress.update(load_words, advance=edb_count[word])
 
-        with Progress() as progress:
-            total = sum(edb2_count.values())
-            load_words2 = progress.add_task("Loading EDB2 words...", total=total)
-
-            for word in edb2_count:
-                edb2_token = self.tokenize(word, prefix="edb2")
-                results = self.search_token(
-                    edb2_token, "edb2", max_count=edb2_count[word]
-                )
-                if word not in global_index:
-                    global_index[word] = set()
-
-                global_index.get(word, set()).update(results)
-                progress.update(load_words2, advance=edb2_count[word])
-
-        databases.truncate_table(self.conn, "edb2")
-        if recrypt:
-            databases.truncate_table(self.conn, "edb")
-
-        with Progress() as progress:
-            total = sum(len(v) for v in global_index.values())
-            add_words = progress.add_task("Adding words to EDB...", total=total)
-
-            for word in global_index:
-                count = edb_count.get(word, 0)
-                for entry in global_index[word]:
-                    str_entry = str(set((entry,)))
-                    self.add_word_helper(word, count, str_entry, "edb")
-                    count += 1
-                    edb_count[word] = count
-                progress.update(add_words, advance=len(global_index[word]))
-            self.conn.commit()
-
-        databases.truncate_table(self.conn, "edb2")
-
-        crypt.encrypt_pickle(edb_count, "edb_count", self.key)
-        file.delete(SERVER_ROOT / "edb2_count")
-        file.delete(CLIENT_ROOT / "edb2_count.pkl")
+def merge_batch_worker(
+    batch: list[tuple[str, int, int]], table_name: str
+) -> tuple[dict[str, int], int, int]:
+    assert _worker_scheme is not None
+    return _worker_scheme.merge_batch(batch, table_name)
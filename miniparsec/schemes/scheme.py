@@ -1,24 +1,53 @@
+import threading
 from pathlib import Path
+from typing import TYPE_CHECKING
 
 from psycopg import Connection
+from psycopg_pool import ConnectionPool
 
-from miniparsec import crypt
+from miniparsec import crypt, index, query
 from miniparsec.paths import CLIENT_ROOT, SERVER_ROOT
+from miniparsec.state import DocumentStore
+from miniparsec.storage import PostgresStorage, Storage
 from miniparsec.tokens import Token
 from miniparsec.utils import console, file, folder, timing
 
+if TYPE_CHECKING:
+    # Import circulaire : miniparsec.cache dépend indirectement des schémas
+    from miniparsec.cache import SearchCache
+
 
 class Scheme:
-    def __init__(self, key: bytes, conn: Connection) -> None:
-        self.conn: Connection = conn
+    def __init__(
+        self, key: bytes, storage: Storage | Connection | ConnectionPool
+    ) -> None:
+        # Tables chiffrées : une connexion ou un pool désigne Postgres
+        if not isinstance(storage, Storage):
+            storage = PostgresStorage(storage)
+        self.storage: Storage = storage
         self.key: bytes = key
-        self.protected_filenames: set[str]
         self.tables_names: set[str]
         self.newkey: bytes | None = None
+        self.documents: DocumentStore = DocumentStore("documents", key)
+        self.cache: SearchCache | None = None
+        # Protège l'état client (compteurs, documents) partagé entre threads
+        self.lock: threading.Lock = threading.Lock()
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        state.update(lock=None)
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
 
     def reset(self) -> None:
         folder.empty(CLIENT_ROOT)
         folder.empty(SERVER_ROOT)
+        self.documents.clear()
+        if self.cache is not None:
+            self.cache.clear()
 
     def tokenize(self, word: str, prefix: str = "") -> Token:
         del word, prefix
@@ -32,16 +61,18 @@ class Scheme:
         del token, client_path
         console.log("No token removal method yet.")
 
-    def search_token(
-        self, token: Token, table_name: str
-    ) -> set[str] | set[tuple[str, set[str]]]:
+    def search_token(self, token: Token, table_name: str) -> set[int | str]:
         del token, table_name
         return set()
 
-    def search_word(self, word: str) -> set[str]:
+    def search_word(self, word: str) -> set[int | str]:
         del word
         return set()
 
+    def resolve(self, documents: set[int | str]) -> set[str]:
+        """Chemins des documents trouvés par une recherche."""
+        return self.documents.resolve(documents)
+
     def add_word(self, word: str, client_path: Path) -> None:
         token = self.tokenize(word)
         self.add_token(token, client_path)
@@ -50,18 +81,76 @@ class Scheme:
         token = self.tokenize(word)
         self.remove_token(token, client_path)
 
-    def search_intersection(self, words: list[str]) -> set[str]:
-        sets = [self.search_word(word) for word in words]
-        return set.intersection(*sets)
+    def estimate(self, word: str) -> int | None:
+        """Nombre estimé de résultats pour `word` (None si inconnu)."""
+        del word
+        return None
+
+    def plan(self, words: list[str]) -> list[str]:
+        """Ordonne les mots du plus sélectif au moins sélectif (inconnus en dernier)."""
+        estimates = {word: self.estimate(word) for word in set(words)}
+        return sorted(
+            estimates, key=lambda word: (estimates[word] is None, estimates[word] or 0)
+        )
+
+    def search_intersection(self, words: list[str]) -> set[int | str]:
+        """Intersection incrémentale, en commençant par le mot le plus rare."""
+        result: list[int | str] | None = None
+        for word in self.plan(words):
+            documents = query.sort(self.search_word(word))
+            result = documents if result is None else query.intersect(result, documents)
+            if not result:
+                break
+        return set(result or ())
 
-    def search_union(self, words: list[str]) -> set[str]:
-        sets = [self.search_word(word) for word in words]
-        return set.union(*sets)
+    def search_union(self, words: list[str]) -> set[int | str]:
+        lists = [query.sort(self.search_word(word)) for word in set(words)]
+        return set(query.union(lists))
 
     def add_file_words(self, client_path: Path, verbose=True) -> int:
         del client_path, verbose
         return 0
 
+    def add_files_words(self, client_paths: list[Path], verbose=True) -> int:
+        """Indexe un lot de fichiers, puis écrit toutes leurs entrées d'un coup."""
+        rows: dict[str, list[tuple[bytes, bytes]]] = {}
+        index_length = 0
+        for client_path in client_paths:
+            file_index: set[str]
+            file_index = index.index_file(client_path)
+            index_length += len(file_index)
+            file_rows = self.prepare_file_words(client_path, file_index)
+            for table_name, table_rows in file_rows.items():
+                rows.setdefault(table_name, []).extend(table_rows)
+        self.write_entries(rows)
+        console.log(
+            f"Files: {len(client_paths):6,d}, Unique words : {index_length:6,d}.",
+            verbose=verbose,
+        )
+
+        return index_length
+
+    def prepare_file_words(
+        self, client_path: Path, words: set[str]
+    ) -> dict[str, list[tuple[bytes, bytes]]]:
+        """Réserve les compteurs d'un fichier indexé et calcule ses entrées.
+
+        Returns:
+            Lignes (token, file) à écrire, par table.
+
+        Par défaut (schémas sans ingestion par lots), le fichier est indexé et
+        ajouté directement, et il n'y a pas d'entrée à écrire.
+        """
+        del words
+        with self.lock:
+            self.add_file_words(client_path, verbose=False)
+        return {}
+
+    def write_entries(self, rows: dict[str, list[tuple[bytes, bytes]]]) -> None:
+        """Écrit des entrées calculées par `prepare_file_words`."""
+        del rows
+        pass
+
     def remove_file_words(self, client_path: Path) -> None:
         del client_path
         pass
@@ -83,5 +172,20 @@ class Scheme:
         # file.delete(temp_client_path)
         # file.delete(server_path)
 
+    def remove_files(self, client_paths: list[Path]) -> None:
+        """Retire un lot de fichiers (par défaut, un par un)."""
+        for client_path in client_paths:
+            self.remove_file(client_path)
+
+    def staging_size(self) -> tuple[int, int]:
+        """Entrées et mots en attente de fusion (aucun par défaut)."""
+        return 0, 0
+
     def merge(self) -> None:
         pass
+
+    def close(self) -> None:
+        """Sauvegarde l'état client gardé en mémoire (cache de recherche)."""
+        if self.cache is not None:
+            self.cache.save()
+            console.log(self.cache.stats())
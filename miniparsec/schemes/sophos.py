@@ -1,89 +1,161 @@
 from pathlib import Path
 
 from psycopg import Connection
+from psycopg_pool import ConnectionPool
 
-from miniparsec import crypt
+from miniparsec import crypt, index
 from miniparsec.paths import CLIENT_ROOT, SERVER_ROOT
+from miniparsec.state import CounterStore
+from miniparsec.storage import Storage
+from miniparsec.tdp import RSAKey, generate_rsa_key
 from miniparsec.tokens import SophosToken
-from miniparsec.utils import console, file, folder, timing
+from miniparsec.utils import console
 
 from .scheme import Scheme
 
+# Taille du module RSA de la permutation à trappe, en bits.
+RSA_BITS = 2048
+
 
 class Sophos(Scheme):
-    def __init__(self, key: bytes, conn: Connection) -> None:
-        self.conn: Connection = conn
-        self.key: bytes = key
-        self.protected_filenames: set[str]
-        self.tables_names: set[str]
-        self.newkey: bytes | None = None
+    """Schéma Sophos (Bost, 2016), à confidentialité persistante.
+
+    Pour chaque mot, le client garde le dernier jeton de recherche `ST_c` et le
+    nombre d'entrées `c + 1`. Un ajout calcule `ST_{c+1} = π⁻¹(ST_c)` avec la
+    trappe RSA : le serveur, qui ne connaît que la permutation publique π, ne
+    peut pas relier une nouvelle entrée aux jetons déjà reçus. Une recherche
+    envoie `K_w` et `ST_c` ; le serveur remonte la chaîne `ST_{i-1} = π(ST_i)`
+    et récupère toutes ses entrées en requêtes groupées. Aucune fusion n'est
+    nécessaire.
+    """
+
+    def __init__(
+        self,
+        key: bytes,
+        storage: Storage | Connection | ConnectionPool,
+        bits: int = RSA_BITS,
+    ) -> None:
+        super().__init__(key, storage)
+        self.tables_names: set[str] = {"sophos"}
+        self.bits: int = bits
+        self.rsa_key: RSAKey | None = None
+        self.tokens_store: CounterStore = CounterStore("sophos_tokens", key)
+        self.counts_store: CounterStore = CounterStore("sophos_count", key)
 
     def reset(self) -> None:
-        folder.empty(CLIENT_ROOT)
-        folder.empty(SERVER_ROOT)
+        super().reset()
+        self.storage.create("sophos")
+        self.tokens_store.clear()
+        self.counts_store.clear()
+        self.rsa_key = None
+        self.get_rsa_key()
+
+    def get_rsa_key(self) -> RSAKey:
+        """Trappe RSA du client, générée au premier usage."""
+        if self.rsa_key is None:
+            if (SERVER_ROOT / "sophos_key").exists():
+                self.rsa_key = crypt.decrypt_pickle("sophos_key", self.key, None)
+            else:
+                self.rsa_key = generate_rsa_key(self.bits)
+                crypt.encrypt_pickle(self.rsa_key, "sophos_key", self.key)
+                console.log(f"Sophos trapdoor generated ({self.bits} bits).")
+        assert self.rsa_key is not None
+        return self.rsa_key
+
+    def word_key(self, word: str) -> bytes:
+        return crypt.hmac(f"sophos{word}", self.key)
 
     def tokenize(self, word: str, prefix: str = "") -> SophosToken:
-        del word, prefix
-        return SophosToken()
-
-    def add_token(self, token: SophosToken, client_path: Path) -> None:
-        del token, client_path
-        pass
+        """Jeton de recherche de `word` (compteur nul si le mot est absent)."""
+        del prefix
+        count = self.counts_store.get(word, 0)
+        return SophosToken(self.word_key(word), self.tokens_store.get(word), count)
+
+    def get_count(self, word: str) -> int:
+        return self.counts_store.get(word, 0)
+
+    def estimate(self, word: str) -> int | None:
+        return self.get_count(index.stem(word))
+
+    def make_entry(self, word_key: bytes, st: int, doc_id: int) -> tuple[bytes, bytes]:
+        """Ligne (token, file) de l'entrée de jeton `st` : `UT`, et `ind ⊕ masque`."""
+        st_bytes = st.to_bytes(self.get_rsa_key().size, "big")
+        ut, mask = crypt.hmac_many([b"1" + st_bytes, b"2" + st_bytes], word_key)
+        value = doc_id ^ int(mask[:8], 16)
+        return ut, value.to_bytes(4, "little")
+
+    def prepare_file_words(
+        self, client_path: Path, words: set[str]
+    ) -> dict[str, list[tuple[bytes, bytes]]]:
+        # Un calcul de trappe par mot ajouté, quel que soit le nombre d'entrées
+        rsa_key = self.get_rsa_key()
+        rows = []
+        with self.lock:
+            doc_id = self.documents.add(str(client_path.relative_to(CLIENT_ROOT)))
+            for word in words:
+                count = self.counts_store.get(word, 0)
+                if count:
+                    st = rsa_key.invert(self.tokens_store.get(word))
+                else:
+                    st = rsa_key.random_element()
+                self.tokens_store[word] = st
+                self.counts_store[word] = count + 1
+                rows.append(self.make_entry(self.word_key(word), st, doc_id))
+            if self.cache is not None:
+                self.cache.invalidate(words)
+        return {"sophos": rows}
+
+    def write_entries(self, rows: dict[str, list[tuple[bytes, bytes]]]) -> None:
+        with self.lock:
+            self.documents.flush()
+        for table_name, table_rows in rows.items():
+            self.storage.put_many(table_name, table_rows)
+        with self.lock:
+            self.tokens_store.flush()
+            self.counts_store.flush()
 
-    def remove_token(self, token: SophosToken, client_path: Path) -> None:
-        del token, client_path
-        console.log("No token removal method yet.")
+    def add_file_words(self, client_path: Path, verbose=True) -> int:
+        return self.add_files_words([client_path], verbose=verbose)
 
-    def search_token(
+    def search_token(  # type: ignore[override]
         self, token: SophosToken, table_name: str
-    ) -> set[str] | set[tuple[str, set[str]]]:
-        del token, table_name
-        return set()
-
-    def search_word(self, word: str) -> set[str]:
-        del word
-        return set()
-
-    def add_word(self, word: str, client_path: Path) -> None:
+    ) -> set[int | str]:
+        """Parcours de la chaîne des jetons, côté serveur (clé publique seule)."""
+        rsa_key = self.get_rsa_key()
+        size = rsa_key.size
+        chain = []
+        st = token.st
+        for _ in range(token.count):
+            chain.append(st.to_bytes(size, "big"))
+            st = rsa_key.forward(st)
+
+        contents = [prefix + st_bytes for st_bytes in chain for prefix in (b"1", b"2")]
+        keys = crypt.hmac_many(contents, token.kw)
+        masks = {ut: int(mask[:8], 16) for ut, mask in zip(keys[::2], keys[1::2])}
+
+        found = self.storage.get_many(table_name, list(masks))
+        result: set[int | str] = set()
+        for ut, values in found.items():
+            for value in values:
+                result.add(int.from_bytes(value, "little") ^ masks[ut])
+        return result
+
+    def search_word(self, word: str) -> set[int | str]:
+        word = index.stem(word)
         token = self.tokenize(word)
-        self.add_token(token, client_path)
-
-    def remove_word(self, word: str, client_path: Path) -> None:
-        token = self.tokenize(word)
-        self.remove_token(token, client_path)
-
-    def search_intersection(self, words: list[str]) -> set[str]:
-        sets = [self.search_word(word) for word in words]
-        return set.intersection(*sets)
-
-    def search_union(self, words: list[str]) -> set[str]:
-        sets = [self.search_word(word) for word in words]
-        return set.union(*sets)
-
-    def add_file_words(self, client_path: Path, verbose=True) -> int:
-        del client_path, verbose
-        return 0
-
-    def remove_file_words(self, client_path: Path) -> None:
-        del client_path
-        pass
-
-    def add_file(self, client_path: Path, verbose=True) -> tuple[int, float, float]:
-        t1 = timing.timing(crypt.encrypt_file, verbose=False)(client_path, self.key)
-        t2, count = timing.timing(self.add_file_words, verbose=False)(
-            client_path, verbose=verbose
-        )
-        return t1, t2, count
-
-    def remove_file(self, client_path: Path):
-        server_path = file.get_server_path(client_path)
-        temp_basename = f"temp_{client_path.name}"
-
-        crypt.decrypt_file(server_path, self.key, temp_basename)
-        temp_client_path = file.rename(client_path, temp_basename)
-        self.remove_file_words(temp_client_path)
-        # file.delete(temp_client_path)
-        # file.delete(server_path)
-
-    def merge(self) -> None:
-        pass
+        if not token.count:
+            return set()
+
+        version = None
+        if self.cache is not None:
+            version = token.count
+            cached = self.cache.get(word, version)
+            if cached is not None:
+                console.log(f"{len(cached)} results in cache.")
+                return set(cached)
+
+        results = self.search_token(token, "sophos")
+        console.log(f"{len(results)} results in table sophos.")
+        if self.cache is not None:
+            self.cache.put(word, version, list(results))
+        return results
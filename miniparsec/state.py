@@ -0,0 +1,365 @@
+"""Stockage chiffré et incrémental de l'état client (compteurs, documents)."""
+
+import os
+from collections import OrderedDict
+from collections.abc import Iterable, Iterator
+from pathlib import Path
+
+from miniparsec import crypt
+from miniparsec.paths import SERVER_ROOT
+from miniparsec.utils import console, folder
+
+# Nombre de pages sur lesquelles sont répartis les mots.
+PAGES = 256
+
+# Nombre de mots journalisés au-delà duquel le journal est compacté en pages.
+SNAPSHOT_SIZE = 50_000
+
+# Taille maximale des pages gardées en mémoire, en octets, et taille estimée
+# d'un compteur en mémoire (mot, entier et case du dictionnaire).
+CACHE_BYTES = 64 * 2**20
+ENTRY_BYTES = 128
+
+
+def encode_record(record: object, key: bytes) -> bytes:
+    """Enregistrement chiffré, préfixé par sa longueur."""
+    encrypted = crypt.dumps(record, key)
+    return len(encrypted).to_bytes(4, "big") + encrypted
+
+
+def append_record(path: Path, record: object, key: bytes) -> None:
+    """Ajoute un enregistrement chiffré à un journal."""
+    with open(path, "ab") as f:
+        f.write(encode_record(record, key))
+
+
+def read_records(path: Path, key: bytes) -> Iterator[object]:
+    """Relit les enregistrements d'un journal (un enregistrement tronqué est ignoré)."""
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return
+    position = 0
+    while position + 4 <= len(data):
+        length = int.from_bytes(data[position : position + 4], "big")
+        record = data[position + 4 : position + 4 + length]
+        if len(record) < length:
+            console.warning(f"Truncated record ignored in '{path}'.")
+            return
+        yield crypt.loads(record, key)
+        position += 4 + length
+
+
+class CounterStore:
+    """Compteurs `mot -> entier` chiffrés côté serveur.
+
+    Les modifications sont gardées en mémoire, puis ajoutées à un journal de
+    deltas chiffrés par `flush`. Le journal est périodiquement compacté dans des
+    pages chiffrées, chargées à la demande : seuls le journal courant et les
+    pages lues récemment, dans la limite de `cache_bytes`, sont en mémoire.
+    Un compteur nul équivaut à un mot absent.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        key: bytes,
+        pages: int = PAGES,
+        snapshot_size: int = SNAPSHOT_SIZE,
+        cache_bytes: int = CACHE_BYTES,
+    ) -> None:
+        self.name: str = name
+        self.key: bytes = key
+        self.pages: int = pages
+        self.snapshot_size: int = snapshot_size
+        self.cache_bytes: int = cache_bytes
+        self.folder: Path = SERVER_ROOT / f"{name}.d"
+        self.log_path: Path = self.folder / "log"
+        self.pending: dict[str, int] = {}  # Pas encore journalisé
+        self.overlay: dict[str, int] = {}  # Journalisé, pas encore en page
+        self.cache: OrderedDict[int, dict[str, int]] = OrderedDict()
+        self.loaded: bool = False
+
+    def __getstate__(self) -> dict:
+        # Seule la configuration est transmise : l'état est relu depuis le disque
+        state = self.__dict__.copy()
+        state.update(pending={}, overlay={}, cache=OrderedDict(), loaded=False)
+        return state
+
+    def exists(self) -> bool:
+        return self.folder.exists() or (SERVER_ROOT / self.name).exists()
+
+    def load(self) -> None:
+        """Relit le journal, et importe l'ancien pickle s'il existe encore."""
+        if self.loaded:
+            return
+        self.loaded = True
+        legacy_path = SERVER_ROOT / self.name
+        if not self.folder.exists() and legacy_path.exists():
+            legacy: dict[str, int] = crypt.decrypt_pickle(self.name, self.key, {})
+            folder.create(self.folder, verbose=False)
+            self.pending.update(legacy)
+            self.snapshot()
+            os.remove(legacy_path)
+            console.log(f"Counters '{self.name}' imported from pickle.")
+            return
+        for record in read_records(self.log_path, self.key):
+            self.overlay.update(record)  # type: ignore[call-overload]
+
+    def reload(self) -> None:
+        """Oublie l'état relu, pour voir les écritures d'un autre processus.
+
+        Les modifications en attente sont gardées.
+        """
+        self.overlay = {}
+        self.cache.clear()
+        self.loaded = False
+
+    def page_index(self, word: str) -> int:
+        return int(crypt.hmac(word, self.key)[:8], 16) % self.pages
+
+    def page_path(self, page: int) -> Path:
+        return self.folder / f"{page:04d}"
+
+    def read_page(self, page: int) -> dict[str, int]:
+        try:
+            with open(self.page_path(page), "rb") as f:
+                return crypt.loads(f.read(), self.key)
+        except FileNotFoundError:
+            return {}
+
+    def write_page(self, page: int, content: dict[str, int]) -> None:
+        crypt.write_atomic(self.page_path(page), crypt.dumps(content, self.key))
+
+    def get_page(self, page: int) -> dict[str, int]:
+        if page in self.cache:
+            self.cache.move_to_end(page)
+            return self.cache[page]
+        content = self.read_page(page)
+        self.cache[page] = content
+        # Les pages grossissent en place : leur taille est recomptée ici
+        cached = sum(map(len, self.cache.values())) * ENTRY_BYTES
+        while cached > self.cache_bytes and len(self.cache) > 1:
+            _, evicted = self.cache.popitem(last=False)
+            cached -= len(evicted) * ENTRY_BYTES
+        return content
+
+    def get(self, word: str, default: int = 0) -> int:
+        self.load()
+        if word in self.pending:
+            value = self.pending[word]
+        elif word in self.overlay:
+            value = self.overlay[word]
+        else:
+            value = self.get_page(self.page_index(word)).get(word, 0)
+        return value if value else default
+
+    def __getitem__(self, word: str) -> int:
+        return self.get(word)
+
+    def __setitem__(self, word: str, value: int) -> None:
+        self.load()
+        self.pending[word] = value
+
+    def __contains__(self, word: str) -> bool:
+        return self.get(word) != 0
+
+    def remove(self, word: str) -> None:
+        self[word] = 0
+
+    def flush(self) -> None:
+        """Journalise les modifications en attente (coût selon leur nombre)."""
+        if not self.pending:
+            return
+        folder.create(self.folder, verbose=False)
+        append_record(self.log_path, self.pending, self.key)
+        self.overlay.update(self.pending)
+        self.pending = {}
+        if len(self.overlay) >= self.snapshot_size:
+            self.snapshot()
+
+    def snapshot(self) -> None:
+        """Compacte le journal dans les pages, puis le vide."""
+        self.load()
+        self.overlay.update(self.pending)
+        self.pending = {}
+        folder.create(self.folder, verbose=False)
+
+        by_page: dict[int, dict[str, int]] = {}
+        for word, value in self.overlay.items():
+            by_page.setdefault(self.page_index(word), {})[word] = value
+        for page, updates in by_page.items():
+            content = self.get_page(page)
+            for word, value in updates.items():
+                if value:
+                    content[word] = value
+                else:
+                    content.pop(word, None)
+            self.write_page(page, content)
+
+        self.overlay = {}
+        try:
+            os.remove(self.log_path)
+        except FileNotFoundError:
+            pass
+
+    def items(self) -> Iterator[tuple[str, int]]:
+        """Parcourt les compteurs non nuls, une page à la fois."""
+        self.load()
+        by_page: dict[int, dict[str, int]] = {}
+        for word, value in (self.overlay | self.pending).items():
+            by_page.setdefault(self.page_index(word), {})[word] = value
+        for page in range(self.pages):
+            content = self.cache.get(page) or self.read_page(page)
+            content = content | by_page.get(page, {})
+            yield from [(word, value) for word, value in content.items() if value]
+
+    def __iter__(self) -> Iterator[str]:
+        return (word for word, _ in self.items())
+
+    def values(self) -> Iterator[int]:
+        return (value for _, value in self.items())
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self.items())
+
+    def clear(self) -> None:
+        """Efface tous les compteurs (un magasin vide reste un état connu)."""
+        folder.delete(self.folder, verbose=False)
+        folder.create(self.folder, verbose=False)
+        self.pending = {}
+        self.overlay = {}
+        self.cache.clear()
+        self.loaded = True
+
+    def rekey(self, key: bytes) -> None:
+        """Re-chiffre le magasin avec une nouvelle clé, page par page."""
+        new_store = CounterStore(f"{self.name}.new", key, self.pages)
+        new_store.clear()
+        for word, value in self.items():
+            new_store[word] = value
+            if len(new_store.pending) >= self.snapshot_size:
+                new_store.flush()
+        self.replace(new_store)
+
+    def replace(self, other: "CounterStore") -> None:
+        """Remplace le contenu du magasin par celui de `other` (qui est vidé)."""
+        other.snapshot()
+        folder.delete(self.folder, verbose=False)
+        os.rename(other.folder, self.folder)
+        self.key = other.key
+        self.pending = {}
+        self.overlay = {}
+        self.cache.clear()
+        self.loaded = True
+        other.clear()
+        folder.delete(other.folder, verbose=False)
+
+
+class DocumentStore:
+    """Dictionnaire chiffré des documents : `chemin <-> identifiant`.
+
+    Les identifiants sont des entiers denses sur 32 bits, attribués dans
+    l'ordre d'ajout. Les nouvelles associations sont ajoutées à un journal
+    chiffré par `flush` ; le dictionnaire est relu au premier accès.
+    """
+
+    def __init__(self, name: str, key: bytes) -> None:
+        self.name: str = name
+        self.key: bytes = key
+        self.folder: Path = SERVER_ROOT / f"{name}.d"
+        self.log_path: Path = self.folder / "log"
+        self.paths: list[str | None] = []
+        self.ids: dict[str, int] = {}
+        self.pending: list[tuple[int, str | None]] = []
+        self.loaded: bool = False
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        state.update(paths=[], ids={}, pending=[], loaded=False)
+        return state
+
+    def load(self) -> None:
+        if self.loaded:
+            return
+        self.loaded = True
+        for record in read_records(self.log_path, self.key):
+            for doc_id, path in record:  # type: ignore[attr-defined]
+                self.assign(doc_id, path)
+
+    def assign(self, doc_id: int, path: str | None) -> None:
+        if doc_id >= len(self.paths):
+            self.paths.extend([None] * (doc_id + 1 - len(self.paths)))
+        old_path = self.paths[doc_id]
+        if old_path is not None and self.ids.get(old_path) == doc_id:
+            del self.ids[old_path]
+        self.paths[doc_id] = path
+        if path is not None:
+            self.ids[path] = doc_id
+
+    def add(self, path: str) -> int:
+        """Identifiant du document `path`, attribué s'il est nouveau."""
+        self.load()
+        if path in self.ids:
+            return self.ids[path]
+        doc_id = len(self.paths)
+        if doc_id >= 2**32:
+            raise ValueError("Document identifiers exhausted.")
+        self.assign(doc_id, path)
+        self.pending.append((doc_id, path))
+        return doc_id
+
+    def __len__(self) -> int:
+        """Nombre d'identifiants attribués, y compris ceux des documents retirés."""
+        self.load()
+        return len(self.paths)
+
+    def remove(self, path: str) -> int | None:
+        """Retire le document `path` ; son identifiant n'est jamais réattribué."""
+        self.load()
+        doc_id = self.ids.get(path)
+        if doc_id is not None:
+            self.assign(doc_id, None)
+            self.pending.append((doc_id, None))
+        return doc_id
+
+    def get_id(self, path: str) -> int | None:
+        self.load()
+        return self.ids.get(path)
+
+    def get_path(self, doc_id: int) -> str | None:
+        self.load()
+        return self.paths[doc_id] if doc_id < len(self.paths) else None
+
+    def resolve(self, documents: Iterable[int | str]) -> set[str]:
+        """Chemins des documents (les chemins d'un ancien format sont gardés)."""
+        paths = set()
+        for document in documents:
+            path = document if isinstance(document, str) else self.get_path(document)
+            if path is not None:
+                paths.add(path)
+        return paths
+
+    def flush(self) -> None:
+        if not self.pending:
+            return
+        folder.create(self.folder, verbose=False)
+        append_record(self.log_path, self.pending, self.key)
+        self.pending = []
+
+    def clear(self) -> None:
+        folder.delete(self.folder, verbose=False)
+        self.paths = []
+        self.ids = {}
+        self.pending = []
+        self.loaded = True
+
+    def rekey(self, key: bytes) -> None:
+        """Re-chiffre le dictionnaire, réécrit en un seul enregistrement."""
+        self.load()
+        self.flush()
+        records = [(i, path) for i, path in enumerate(self.paths) if path is not None]
+        folder.create(self.folder, verbose=False)
+        crypt.write_atomic(self.log_path, encode_record(records, key))
+        self.key = key
@@ -0,0 +1,173 @@
+"""Dictionnaire chiffré immuable, dans un fichier servi par `mmap`.
+
+Format du fichier (entiers petit-boutistes) :
+- en-tête : magique, version, log2 du nombre de cases, nombre d'entrées ;
+- table de hachage à adressage ouvert (sondage linéaire), une case par entrée :
+  token, position et longueur de la valeur (position nulle : case vide) ;
+- segment contigu des ciphertexts.
+
+Un token présent plusieurs fois occupe plusieurs cases de la même grappe. Les
+valeurs lues sont des `memoryview` sur le fichier projeté, sans copie : la
+projection est libérée avec la dernière vue.
+"""
+
+import mmap
+import struct
+from collections.abc import Iterable, Iterator
+from pathlib import Path
+
+from miniparsec.databases import TOKEN_SIZE
+
+MAGIC = b"MPSE"
+VERSION = 1
+
+HEADER = struct.Struct("<4sBB2xQ")
+SLOT = struct.Struct(f"<{TOKEN_SIZE}sQI4x")
+POSITION = struct.Struct("<Q")
+
+# Lignes mises de côté avant construction : token, longueur, valeur.
+SPOOL_ROW = struct.Struct(f"<{TOKEN_SIZE}sI")
+
+# Taux de remplissage maximal de la table de hachage.
+LOAD_FACTOR = 0.5
+
+# Multiplicateur du hachage de Fibonacci (2^64 / φ).
+GOLDEN = 0x9E3779B97F4A7C15
+MASK = 2**64 - 1
+
+
+def slot_index(token: bytes, bits: int) -> int:
+    """Case initiale d'un token : bits de poids fort d'un hachage multiplicatif."""
+    return ((int.from_bytes(token[:8], "little") * GOLDEN) & MASK) >> (64 - bits)
+
+
+def write_table(
+    path: Path, rows: Iterable[tuple[bytes, bytes | memoryview]], count: int
+) -> int:
+    """Écrit un dictionnaire statique.
+
+    Args:
+        count: Majorant du nombre de lignes, qui fixe la taille de la table.
+
+    Returns:
+        Nombre de lignes écrites.
+    """
+    bits = (max(1, int(count / LOAD_FACTOR)) - 1).bit_length()
+    slots = 1 << bits
+    values_offset = HEADER.size + slots * SLOT.size
+    written = 0
+    with open(path, "w+b") as f:
+        f.truncate(values_offset)
+        with mmap.mmap(f.fileno(), values_offset) as table:
+            # Les valeurs sont ajoutées à la suite de la table, en flux
+            f.seek(values_offset)
+            position = values_offset
+            for token, value in rows:
+                if len(token) != TOKEN_SIZE:
+                    raise ValueError(f"Invalid token size ({len(token)}).")
+                if written == count:
+                    raise ValueError(f"More than {count} rows.")
+                index = slot_index(token, bits)
+                while POSITION.unpack_from(
+                    table, HEADER.size + index * SLOT.size + TOKEN_SIZE
+                )[0]:
+                    index = (index + 1) & (slots - 1)
+                offset = HEADER.size + index * SLOT.size
+                SLOT.pack_into(table, offset, token, position, len(value))
+                f.write(value)
+                position += len(value)
+                written += 1
+            HEADER.pack_into(table, 0, MAGIC, VERSION, bits, written)
+    return written
+
+
+class StaticTable:
+    """Dictionnaire statique projeté en mémoire, en lecture seule."""
+
+    def __init__(self, path: Path) -> None:
+        self.path: Path = path
+        with open(path, "rb") as f:
+            self.map: mmap.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view: memoryview = memoryview(self.map)
+        magic, version, self.bits, self.count = HEADER.unpack_from(self.map)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"'{path}' is not a static table.")
+        self.mask: int = (1 << self.bits) - 1
+
+    def __enter__(self) -> "StaticTable":
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Libère la projection, sauf si des valeurs lues sont encore vues."""
+        self.view.release()
+        try:
+            self.map.close()
+        except BufferError:
+            # La projection est libérée avec la dernière vue
+            pass
+
+    def __len__(self) -> int:
+        return self.count
+
+    def get(self, token: bytes) -> list[memoryview]:
+        """Valeurs d'un token, parcourues jusqu'à la première case vide."""
+        values: list[memoryview] = []
+        index = slot_index(token, self.bits)
+        while True:
+            slot_token, position, length = SLOT.unpack_from(
+                self.map, HEADER.size + index * SLOT.size
+            )
+            if not position:
+                return values
+            if slot_token == token:
+                values.append(self.view[position : position + length])
+            index = (index + 1) & self.mask
+
+    def get_many(self, tokens: Iterable[bytes]) -> dict[bytes, list[memoryview]]:
+        found = {}
+        for token in tokens:
+            values = self.get(token)
+            if values:
+                found[token] = values
+        return found
+
+    def __iter__(self) -> Iterator[tuple[bytes, memoryview]]:
+        for index in range(self.mask + 1):
+            token, position, length = SLOT.unpack_from(
+                self.map, HEADER.size + index * SLOT.size
+            )
+            if position:
+                yield token, self.view[position : position + length]
+
+
+def append_spool(path: Path, rows: Iterable[tuple[bytes, bytes]]) -> int:
+    """Met de côté des lignes, en attendant la construction de leur table."""
+    count = 0
+    with open(path, "ab") as f:
+        for token, value in rows:
+            if len(token) != TOKEN_SIZE:
+                raise ValueError(f"Invalid token size ({len(token)}).")
+            f.write(SPOOL_ROW.pack(token, len(value)))
+            f.write(value)
+            count += 1
+    return count
+
+
+def read_spool(path: Path) -> Iterator[tuple[bytes, bytes]]:
+    with open(path, "rb") as f:
+        while header := f.read(SPOOL_ROW.size):
+            token, length = SPOOL_ROW.unpack(header)
+            yield token, f.read(length)
+
+
+def count_spool(path: Path) -> int:
+    """Nombre de lignes mises de côté, sans lire les valeurs."""
+    count = 0
+    with open(path, "rb") as f:
+        while header := f.read(SPOOL_ROW.size):
+            f.seek(SPOOL_ROW.unpack(header)[1], 1)
+            count += 1
+    return count
@@ -0,0 +1,532 @@
+"""Stockage des tables chiffrées, derrière une interface commune.
+
+Une table est un multi-dictionnaire `token -> valeurs` opaque pour le serveur.
+Les schémas n'y accèdent que par `Storage` : la même logique tourne sur
+Postgres, sur SQLite, ou entièrement en mémoire (pour mesurer le coût client
+sans base de données).
+"""
+
+import asyncio
+import os
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from collections.abc import AsyncIterator, Iterable, Iterator
+from contextlib import asynccontextmanager, contextmanager
+from pathlib import Path
+
+from psycopg import AsyncConnection, Connection
+from psycopg_pool import AsyncConnectionPool, ConnectionPool
+
+from miniparsec import databases, static
+from miniparsec.static import StaticTable
+from miniparsec.utils import console
+
+# Nombre maximal de tokens par requête groupée.
+BATCH_SIZE = 1000
+
+# Base SQLite par défaut (hors de SERVER_ROOT, que `reset` vide).
+SQLITE_PATH = Path("data/edb.sqlite")
+
+# Nombre maximal de paramètres d'une requête SQLite.
+SQLITE_BATCH_SIZE = 500
+
+# Dossier des tables statiques, et tables servies ainsi : EDB et sa table de
+# fusion.
+STATIC_ROOT = Path("data/static")
+STATIC_TABLES = frozenset({"edb", "edb_merge"})
+
+
+class Storage(ABC):
+    """Interface des tables chiffrées (token, file)."""
+
+    # Accessible depuis d'autres processus (workers de fusion)
+    shared: bool = True
+
+    @abstractmethod
+    def create(self, table_name: str) -> None:
+        """(Re)crée une table vide, et son index."""
+
+    @abstractmethod
+    def drop(self, table_name: str) -> None:
+        ...
+
+    @abstractmethod
+    def exists(self, table_name: str) -> bool:
+        ...
+
+    @abstractmethod
+    def get_many(self, table_name: str, tokens: list[bytes]) -> dict[bytes, list]:
+        """Valeurs de plusieurs tokens (les tokens absents sont omis).
+
+        Les valeurs sont des `bytes`, ou des `memoryview` lues sans copie.
+        """
+
+    async def get_many_async(
+        self, table_name: str, tokens: list[bytes]
+    ) -> dict[bytes, list]:
+        return await asyncio.to_thread(self.get_many, table_name, tokens)
+
+    @abstractmethod
+    def put_many(
+        self,
+        table_name: str,
+        rows: Iterable[tuple[bytes, bytes]],
+        replaced: Iterable[bytes] = (),
+    ) -> int:
+        """Insère des lignes, après avoir supprimé celles des tokens `replaced`.
+
+        Les deux opérations sont atomiques : une lecture concurrente voit les
+        anciennes lignes ou les nouvelles.
+        """
+
+    def delete_many(self, table_name: str, tokens: list[bytes]) -> None:
+        self.put_many(table_name, (), tokens)
+
+    @abstractmethod
+    def truncate(self, table_name: str) -> None:
+        ...
+
+    @abstractmethod
+    def scan(self, table_name: str) -> Iterator[tuple[bytes, bytes]]:
+        """Toutes les lignes d'une table, en flux."""
+
+    @abstractmethod
+    def replace(self, source_name: str, table_name: str) -> None:
+        """Remplace `table_name` par `source_name`, qui disparaît."""
+
+    def open_worker(self) -> None:
+        """Ouvre les connexions propres à un processus worker."""
+
+    def static(self, table_name: str) -> bool:
+        """Table immuable : elle n'est remplie que par `replace`."""
+        del table_name
+        return False
+
+
+class MemoryStorage(Storage):
+    """Tables en mémoire, dans le processus (sans coût de base de données)."""
+
+    shared = False
+
+    def __init__(self) -> None:
+        self.tables: dict[str, dict[bytes, list[bytes]]] = {}
+        self.lock = threading.Lock()
+
+    def create(self, table_name: str) -> None:
+        with self.lock:
+            self.tables[table_name] = {}
+
+    def drop(self, table_name: str) -> None:
+        with self.lock:
+            self.tables.pop(table_name, None)
+
+    def exists(self, table_name: str) -> bool:
+        with self.lock:
+            return table_name in self.tables
+
+    def get_many(
+        self, table_name: str, tokens: list[bytes]
+    ) -> dict[bytes, list[bytes]]:
+        with self.lock:
+            table = self.tables[table_name]
+            return {token: list(table[token]) for token in tokens if token in table}
+
+    def put_many(
+        self,
+        table_name: str,
+        rows: Iterable[tuple[bytes, bytes]],
+        replaced: Iterable[bytes] = (),
+    ) -> int:
+        rows = list(rows)
+        with self.lock:
+            table = self.tables[table_name]
+            for token in replaced:
+                table.pop(token, None)
+            for token, value in rows:
+                table.setdefault(token, []).append(value)
+        return len(rows)
+
+    def truncate(self, table_name: str) -> None:
+        with self.lock:
+            self.tables[table_name].clear()
+
+    def scan(self, table_name: str) -> Iterator[tuple[bytes, bytes]]:
+        with self.lock:
+            rows = [
+                (token, value)
+                for token, values in self.tables[table_name].items()
+                for value in values
+            ]
+        yield from rows
+
+    def replace(self, source_name: str, table_name: str) -> None:
+        with self.lock:
+            self.tables[table_name] = self.tables.pop(source_name)
+
+
+def quote(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+class SQLiteStorage(Storage):
+    """Tables dans un fichier SQLite, une connexion par thread."""
+
+    def __init__(self, path: Path | str = SQLITE_PATH) -> None:
+        self.path: Path = Path(path)
+        self.local = threading.local()
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        state.update(local=None)
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self.local = threading.local()
+
+    def connection(self) -> sqlite3.Connection:
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=60.0)
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def create(self, table_name: str) -> None:
+        with self.connection() as conn:
+            conn.execute(f"DROP TABLE IF EXISTS {quote(table_name)}")
+            conn.execute(
+                f"CREATE TABLE {quote(table_name)} "
+                "(token BLOB NOT NULL, file BLOB NOT NULL)"
+            )
+            conn.execute(
+                f"CREATE INDEX {quote(f'idx_{table_name}')} "
+                f"ON {quote(table_name)} (token)"
+            )
+
+    def drop(self, table_name: str) -> None:
+        with self.connection() as conn:
+            conn.execute(f"DROP TABLE IF EXISTS {quote(table_name)}")
+
+    def exists(self, table_name: str) -> bool:
+        cursor = self.connection().execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+            (table_name,),
+        )
+        return cursor.fetchone() is not None
+
+    def get_many(
+        self, table_name: str, tokens: list[bytes]
+    ) -> dict[bytes, list[bytes]]:
+        found: dict[bytes, list[bytes]] = {}
+        conn = self.connection()
+        for i in range(0, len(tokens), SQLITE_BATCH_SIZE):
+            batch = tokens[i : i + SQLITE_BATCH_SIZE]
+            placeholders = ", ".join("?" * len(batch))
+            cursor = conn.execute(
+                f"SELECT token, file FROM {quote(table_name)} "
+                f"WHERE token IN ({placeholders})",
+                batch,
+            )
+            for token, value in cursor:
+                found.setdefault(token, []).append(value)
+        return found
+
+    def put_many(
+        self,
+        table_name: str,
+        rows: Iterable[tuple[bytes, bytes]],
+        replaced: Iterable[bytes] = (),
+    ) -> int:
+        table = quote(table_name)
+        with self.connection() as conn:
+            conn.executemany(
+                f"DELETE FROM {table} WHERE token = ?",
+                ((token,) for token in replaced),
+            )
+            cursor = conn.executemany(f"INSERT INTO {table} VALUES (?, ?)", rows)
+        return cursor.rowcount
+
+    def truncate(self, table_name: str) -> None:
+        with self.connection() as conn:
+            conn.execute(f"DELETE FROM {quote(table_name)}")
+
+    def scan(self, table_name: str) -> Iterator[tuple[bytes, bytes]]:
+        yield from self.connection().execute(
+            f"SELECT token, file FROM {quote(table_name)}"
+        )
+
+    def replace(self, source_name: str, table_name: str) -> None:
+        # SQLite ne renomme pas les index : celui de la table est recréé
+        with self.connection() as conn:
+            conn.execute(f"DROP TABLE IF EXISTS {quote(table_name)}")
+            conn.execute(f"DROP INDEX IF EXISTS {quote(f'idx_{source_name}')}")
+            conn.execute(
+                f"ALTER TABLE {quote(source_name)} RENAME TO {quote(table_name)}"
+            )
+            conn.execute(
+                f"CREATE INDEX {quote(f'idx_{table_name}')} "
+                f"ON {quote(table_name)} (token)"
+            )
+
+    def open_worker(self) -> None:
+        self.local = threading.local()
+
+
+class PostgresStorage(Storage):
+    """Tables Postgres, sur une connexion unique ou un pool."""
+
+    def __init__(
+        self,
+        conn: Connection | ConnectionPool,
+        partitions: int = databases.PARTITIONS,
+        prefix: str = "",
+    ) -> None:
+        # Une connexion unique, ou un pool dans lequel chaque opération emprunte
+        # sa connexion
+        self.conn: Connection | None = None
+        self.pool: ConnectionPool | None = None
+        if isinstance(conn, ConnectionPool):
+            self.pool = conn
+        else:
+            self.conn = conn
+        self.async_pool: AsyncConnectionPool | None = None
+        # Nombre de partitions des tables créées (0 : table simple)
+        self.partitions: int = partitions
+        # Préfixe des noms de tables (tables d'un bench, à côté des vraies)
+        self.prefix: str = prefix
+
+    def __getstate__(self) -> dict:
+        # La connexion ne se transmet pas à un autre processus
+        state = self.__dict__.copy()
+        state.update(conn=None, pool=None, async_pool=None)
+        return state
+
+    def name(self, table_name: str) -> str:
+        return self.prefix + table_name
+
+    @contextmanager
+    def connection(self) -> Iterator[Connection]:
+        """Connexion pour une opération : empruntée au pool s'il y en a un."""
+        if self.pool is not None:
+            with databases.connection(self.pool) as conn:
+                yield conn
+        else:
+            assert self.conn is not None
+            yield self.conn
+
+    @asynccontextmanager
+    async def connection_async(self) -> AsyncIterator[AsyncConnection]:
+        """Connexion asynchrone : empruntée au pool asynchrone, ou ouverte."""
+        if self.async_pool is not None:
+            async with databases.connection_async(self.async_pool) as conn:
+                yield conn
+        else:
+            async with await databases.connect_db_async() as conn:
+                yield conn
+
+    def create(self, table_name: str) -> None:
+        with self.connection() as conn:
+            databases.drop_table(conn, self.name(table_name))
+            databases.create_edb_table(conn, self.name(table_name), self.partitions)
+
+    def drop(self, table_name: str) -> None:
+        with self.connection() as conn:
+            databases.drop_table(conn, self.name(table_name))
+
+    def exists(self, table_name: str) -> bool:
+        with self.connection() as conn:
+            return databases.table_exists(conn, self.name(table_name))
+
+    def get_many(
+        self, table_name: str, tokens: list[bytes]
+    ) -> dict[bytes, list[bytes]]:
+        if not tokens:
+            return {}
+        with self.connection() as conn:
+            return databases.select_rows(
+                conn, self.name(table_name), tokens, BATCH_SIZE
+            )
+
+    async def get_many_async(
+        self, table_name: str, tokens: list[bytes]
+    ) -> dict[bytes, list[bytes]]:
+        if not tokens:
+            return {}
+        async with self.connection_async() as conn:
+            return await databases.select_rows_async(
+                conn, self.name(table_name), tokens, BATCH_SIZE
+            )
+
+    def put_many(
+        self,
+        table_name: str,
+        rows: Iterable[tuple[bytes, bytes]],
+        replaced: Iterable[bytes] = (),
+    ) -> int:
+        with self.connection() as conn:
+            databases.delete_rows(conn, self.name(table_name), list(replaced))
+            count = databases.copy_rows(conn, self.name(table_name), rows)
+            conn.commit()
+        return count
+
+    def truncate(self, table_name: str) -> None:
+        with self.connection() as conn:
+            databases.truncate_table(conn, self.name(table_name))
+
+    def scan(self, table_name: str) -> Iterator[tuple[bytes, bytes]]:
+        with self.connection() as conn:
+            yield from databases.read_rows(conn, self.name(table_name))
+
+    def replace(self, source_name: str, table_name: str) -> None:
+        with self.connection() as conn:
+            databases.replace_table(conn, self.name(source_name), self.name(table_name))
+
+    def open_worker(self) -> None:
+        self.conn = databases.connect_db()
+        self.pool = None
+
+
+class StaticStorage(Storage):
+    """EDB dans un fichier statique projeté en mémoire, les autres tables ailleurs.
+
+    Les lignes écrites dans une table statique sont mises de côté (un fichier
+    par processus) : elles ne sont lisibles qu'une fois la table construite
+    par `replace`, ce que fait une fusion complète. Une table statique n'est
+    jamais modifiée en place.
+    """
+
+    def __init__(
+        self,
+        base: Storage,
+        root: Path | str = STATIC_ROOT,
+        tables: Iterable[str] = STATIC_TABLES,
+    ) -> None:
+        self.base: Storage = base
+        self.root: Path = Path(root)
+        self.tables: frozenset[str] = frozenset(tables)
+        self.shared = base.shared
+        self.opened: dict[str, StaticTable] = {}
+        self.lock = threading.Lock()
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        state.update(opened={}, lock=None)
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def static(self, table_name: str) -> bool:
+        return table_name in self.tables
+
+    def path(self, table_name: str) -> Path:
+        return self.root / f"{table_name}.static"
+
+    def spools(self, table_name: str) -> list[Path]:
+        return sorted(self.root.glob(f"{table_name}.*.spool"))
+
+    def table(self, table_name: str) -> StaticTable:
+        with self.lock:
+            table = self.opened.get(table_name)
+            if table is None:
+                table = StaticTable(self.path(table_name))
+                self.opened[table_name] = table
+            return table
+
+    def create(self, table_name: str) -> None:
+        if not self.static(table_name):
+            self.base.create(table_name)
+            return
+        self.drop(table_name)
+        self.root.mkdir(parents=True, exist_ok=True)
+        static.write_table(self.path(table_name), (), 0)
+
+    def drop(self, table_name: str) -> None:
+        if not self.static(table_name):
+            self.base.drop(table_name)
+            return
+        with self.lock:
+            self.opened.pop(table_name, None)
+        for path in [self.path(table_name), *self.spools(table_name)]:
+            path.unlink(missing_ok=True)
+
+    def exists(self, table_name: str) -> bool:
+        if not self.static(table_name):
+            return self.base.exists(table_name)
+        return self.path(table_name).exists()
+
+    def get_many(self, table_name: str, tokens: list[bytes]) -> dict[bytes, list]:
+        if not self.static(table_name):
+            return self.base.get_many(table_name, tokens)
+        return self.table(table_name).get_many(tokens)
+
+    async def get_many_async(
+        self, table_name: str, tokens: list[bytes]
+    ) -> dict[bytes, list]:
+        if not self.static(table_name):
+            return await self.base.get_many_async(table_name, tokens)
+        # Quelques microsecondes par token : inutile de changer de thread
+        return self.table(table_name).get_many(tokens)
+
+    def put_many(
+        self,
+        table_name: str,
+        rows: Iterable[tuple[bytes, bytes]],
+        replaced: Iterable[bytes] = (),
+    ) -> int:
+        if not self.static(table_name):
+            return self.base.put_many(table_name, rows, replaced)
+        if list(replaced):
+            raise ValueError(f"Static table '{table_name}' is immutable.")
+        spool = self.root / f"{table_name}.{os.getpid()}.spool"
+        return static.append_spool(spool, rows)
+
+    def truncate(self, table_name: str) -> None:
+        if not self.static(table_name):
+            self.base.truncate(table_name)
+            return
+        self.create(table_name)
+
+    def scan(self, table_name: str) -> Iterator[tuple[bytes, bytes]]:
+        if not self.static(table_name):
+            yield from self.base.scan(table_name)
+            return
+        for token, value in self.table(table_name):
+            yield token, bytes(value)
+
+    def replace(self, source_name: str, table_name: str) -> None:
+        if not self.static(source_name) and not self.static(table_name):
+            self.base.replace(source_name, table_name)
+            return
+        if not (self.static(source_name) and self.static(table_name)):
+            raise ValueError(
+                f"Cannot replace '{table_name}' by '{source_name}' across storages."
+            )
+        # Construction : lignes de la table source, puis lignes mises de côté
+        source = self.table(source_name)
+        spools = self.spools(source_name)
+        count = len(source) + sum(static.count_spool(path) for path in spools)
+
+        def rows() -> Iterator[tuple[bytes, bytes | memoryview]]:
+            yield from source
+            for path in spools:
+                yield from static.read_spool(path)
+
+        temp_path = self.root / f"{table_name}.static.temp"
+        written = static.write_table(temp_path, rows(), count)
+        os.replace(temp_path, self.path(table_name))
+        for path in [*self.spools(table_name), self.path(source_name), *spools]:
+            path.unlink(missing_ok=True)
+        # Les recherches en cours gardent l'ancienne projection
+        with self.lock:
+            self.opened.pop(source_name, None)
+            self.opened[table_name] = StaticTable(self.path(table_name))
+        console.log(f"Static table '{table_name}' built ({written:,d} rows).")
+
+    def open_worker(self) -> None:
+        self.base.open_worker()
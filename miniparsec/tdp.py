@@ -0,0 +1,83 @@
+"""Permutation à trappe RSA, pour le schéma Sophos."""
+
+import secrets
+from dataclasses import dataclass
+from math import gcd
+
+
+@dataclass
+class RSAKey:
+    """Permutation à trappe RSA : `forward` est publique, `invert` est secrète."""
+
+    n: int
+    e: int
+    d: int
+    p: int
+    q: int
+
+    def __post_init__(self) -> None:
+        # Paramètres du théorème des restes chinois
+        self.dp: int = self.d % (self.p - 1)
+        self.dq: int = self.d % (self.q - 1)
+        self.q_inv: int = pow(self.q, -1, self.p)
+
+    @property
+    def size(self) -> int:
+        """Taille d'un élément, en octets."""
+        return (self.n.bit_length() + 7) // 8
+
+    def forward(self, x: int) -> int:
+        return pow(x, self.e, self.n)
+
+    def invert(self, y: int) -> int:
+        m1 = pow(y, self.dp, self.p)
+        m2 = pow(y, self.dq, self.q)
+        return m2 + self.q * ((m1 - m2) * self.q_inv % self.p)
+
+    def random_element(self) -> int:
+        return secrets.randbelow(self.n - 2) + 2
+
+
+# Petits nombres premiers, pour écarter rapidement la plupart des candidats.
+SMALL_PRIMES = [p for p in range(3, 1000) if all(p % d for d in range(2, p))]
+
+
+def is_probable_prime(n: int, rounds: int = 40) -> bool:
+    """Test de primalité de Miller-Rabin."""
+    if n < 2:
+        return False
+    for p in [2, *SMALL_PRIMES]:
+        if n % p == 0:
+            return n == p
+    r, s = n - 1, 0
+    while r % 2 == 0:
+        r //= 2
+        s += 1
+    for _ in range(rounds):
+        x = pow(secrets.randbelow(n - 3) + 2, r, n)
+        if x in (1, n - 1):
+            continue
+        for _ in range(s - 1):
+            x = pow(x, 2, n)
+            if x == n - 1:
+                break
+        else:
+            return False
+    return True
+
+
+def generate_prime(bits: int, e: int) -> int:
+    while True:
+        # Deux bits de poids fort : le produit de deux premiers fait 2 * bits bits
+        candidate = secrets.randbits(bits) | (3 << (bits - 2)) | 1
+        if gcd(candidate - 1, e) == 1 and is_probable_prime(candidate):
+            return candidate
+
+
+def generate_rsa_key(bits: int = 2048, e: int = 65537) -> RSAKey:
+    p = generate_prime(bits // 2, e)
+    q = generate_prime(bits // 2, e)
+    while q == p:
+        q = generate_prime(bits // 2, e)
+    d = pow(e, -1, (p - 1) * (q - 1))
+    return RSAKey(p * q, e, d, p, q)
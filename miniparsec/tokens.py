@@ -13,11 +13,12 @@ class PiToken(Token):
 
 @dataclass
 class SophosToken(Token):
-    k1: bytes
-    k2: bytes
+    kw: bytes
+    st: int
+    count: int
 
 
 @dataclass
 class DianaToken(Token):
-    k1: bytes
-    k2: bytes
+    kw: bytes
+    nodes: list[tuple[int, bytes]]
@@ -1,12 +1,13 @@
 """Init."""
 
-from . import console, datasets, file, folder, timing, watcher
+from . import console, datasets, file, folder, pipeline, timing, watcher
 
 __all__ = [
     "console",
     "datasets",
     "file",
     "folder",
+    "pipeline",
     "timing",
     "watcher",
 ]
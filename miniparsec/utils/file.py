@@ -1,3 +1,4 @@
+import fcntl
 import os
 from pathlib import Path
 
@@ -25,3 +26,19 @@ def get_server_path(client_path: Path) -> Path:
 
 def rename(file_path: Path, basename: str) -> Path:
     return file_path.parent / basename
+
+
+def lock(lock_path: Path) -> int | None:
+    """Prend un verrou exclusif entre processus, gardé jusqu'à leur fin.
+
+    Renvoie le descripteur du fichier verrou, ou None si un autre processus
+    détient déjà le verrou.
+    """
+    lock_path.parent.mkdir(parents=True, exist_ok=True)
+    fd = os.open(lock_path, os.O_RDWR | os.O_CREAT)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    return fd
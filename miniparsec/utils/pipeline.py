@@ -0,0 +1,391 @@
+"""Chaîne d'ingestion concurrente des fichiers ajoutés par l'utilisateur.
+
+Les événements passent par quatre étages, reliés par des files bornées (un
+étage saturé bloque le précédent) : file d'événements dédoublonnés, extraction
+et indexation, chiffrement (fichier et entrées), puis écriture par lots dans la
+base de données. Les suppressions sont confiées directement à l'étage
+d'écriture, qui les traite par lots elles aussi. Les événements d'un même
+fichier y arrivent dans l'ordre : une suppression suit l'ajout en cours du
+fichier. Un thread à part fusionne la table tampon du schéma quand elle dépasse
+un seuil, sans arrêter l'ingestion. L'échec d'un élément est journalisé, sans
+arrêter son étage.
+"""
+
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from queue import Empty, Queue
+from time import monotonic
+
+from miniparsec import crypt, index
+from miniparsec.schemes import Scheme
+from miniparsec.utils import console
+
+# Nombre maximal d'événements en attente.
+EVENTS_SIZE = 10_000
+
+# Taille des files entre les étages.
+QUEUE_SIZE = 256
+
+# Nombre de threads d'extraction et de chiffrement.
+EXTRACT_WORKERS = 4
+CRYPTO_WORKERS = 2
+
+# Un lot est écrit dès qu'il atteint `BATCH_ROWS` entrées, ou après `BATCH_DELAY`
+# secondes.
+BATCH_ROWS = 50_000
+BATCH_DELAY = 0.5
+
+# Seuils de fusion automatique : entrées ou mots en attente dans la table
+# tampon, ou délai depuis la dernière fusion (None : seuil désactivé). Ils sont
+# vérifiés toutes les `MERGE_INTERVAL` secondes.
+MERGE_ROWS = 1_000_000
+MERGE_WORDS = 200_000
+MERGE_DELAY: float | None = 3600.0
+MERGE_INTERVAL = 5.0
+
+# Marque de fin, envoyée à chaque thread d'un étage.
+STOP = object()
+
+
+class EventQueue:
+    """File bornée d'événements `(chemin, type)`, sans doublon.
+
+    Un événement déjà en attente n'est pas ajouté une seconde fois, et la
+    suppression d'un fichier dont l'ajout n'est pas encore traité annule cet
+    ajout. Un seul événement par chemin est en cours de traitement : le suivant
+    est distribué une fois le précédent terminé (`done`).
+    """
+
+    def __init__(self, max_size: int = EVENTS_SIZE) -> None:
+        self.max_size: int = max_size
+        self.events: OrderedDict[tuple[Path, str], None] = OrderedDict()
+        self.condition = threading.Condition()
+        self.closed: bool = False
+        self.active: set[Path] = set()  # Chemins d'un événement en cours
+        self.received: int = 0
+        self.coalesced: int = 0
+
+    def put(self, path: Path, event_type: str) -> None:
+        with self.condition:
+            self.received += 1
+            if (path, event_type) in self.events:
+                self.coalesced += 1
+                return
+            if event_type == "deleted" and (path, "created") in self.events:
+                del self.events[path, "created"]
+                self.coalesced += 2
+                self.condition.notify_all()
+                return
+            while len(self.events) >= self.max_size and not self.closed:
+                self.condition.wait()
+            self.events[path, event_type] = None
+            self.condition.notify_all()
+
+    def get(self) -> tuple[Path, str] | None:
+        """Prochain événement d'un chemin libre (None : file fermée et vide)."""
+        with self.condition:
+            while True:
+                event = next((e for e in self.events if e[0] not in self.active), None)
+                if event is not None:
+                    break
+                if not self.events and self.closed:
+                    return None
+                self.condition.wait()
+            del self.events[event]
+            self.active.add(event[0])
+            self.condition.notify_all()
+            return event
+
+    def done(self, path: Path) -> None:
+        """Libère le chemin d'un événement distribué par `get`."""
+        with self.condition:
+            self.active.discard(path)
+            self.condition.notify_all()
+
+    def close(self) -> None:
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def __len__(self) -> int:
+        return len(self.events)
+
+
+class AutoMerge:
+    """Fusion en tâche de fond, déclenchée par la taille de la table tampon.
+
+    Le schéma fige sa table tampon avant de la fusionner : les ajouts vont dans
+    l'autre pendant la fusion. La durée des fusions est ajoutée à
+    `stats["merge"]`.
+    """
+
+    def __init__(
+        self,
+        scheme: Scheme,
+        stats: dict,
+        stats_lock: threading.Lock,
+        rows: int | None = MERGE_ROWS,
+        words: int | None = MERGE_WORDS,
+        delay: float | None = MERGE_DELAY,
+        interval: float = MERGE_INTERVAL,
+    ) -> None:
+        self.scheme: Scheme = scheme
+        self.stats: dict = stats
+        self.stats_lock = stats_lock
+        self.rows: int | None = rows
+        self.words: int | None = words
+        self.delay: float | None = delay
+        self.interval: float = interval
+        self.last_merge: float = monotonic()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="merge", daemon=True)
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def close(self) -> None:
+        """Arrête le thread, après la fusion en cours s'il y en a une."""
+        self.stopped.set()
+        self.thread.join()
+
+    def is_due(self) -> bool:
+        rows, words = self.scheme.staging_size()
+        if not rows:
+            return False
+        return (
+            (self.rows is not None and rows >= self.rows)
+            or (self.words is not None and words >= self.words)
+            or (self.delay is not None and monotonic() - self.last_merge >= self.delay)
+        )
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            if not self.is_due():
+                continue
+            start = monotonic()
+            try:
+                self.scheme.merge()
+            except Exception as e:
+                console.error(f"Background merge failed: {e}")
+                continue
+            self.last_merge = monotonic()
+            with self.stats_lock:
+                self.stats["merge"] += self.last_merge - start
+
+
+class IngestPipeline:
+    """Ingestion des fichiers en étages concurrents.
+
+    Les compteurs de chaque étage (éléments traités, durée cumulée) sont tenus
+    dans `stats`, sous les clés "events", "extract", "crypto" et "write". Les
+    options `merge_*` règlent la fusion automatique (`AutoMerge`).
+    """
+
+    def __init__(
+        self,
+        scheme: Scheme,
+        stats: dict,
+        extract_workers: int = EXTRACT_WORKERS,
+        crypto_workers: int = CRYPTO_WORKERS,
+        queue_size: int = QUEUE_SIZE,
+        batch_rows: int = BATCH_ROWS,
+        batch_delay: float = BATCH_DELAY,
+        merge_rows: int | None = MERGE_ROWS,
+        merge_words: int | None = MERGE_WORDS,
+        merge_delay: float | None = MERGE_DELAY,
+        merge_interval: float = MERGE_INTERVAL,
+    ) -> None:
+        self.scheme: Scheme = scheme
+        self.stats: dict = stats
+        self.stats_lock = threading.Lock()
+        self.batch_rows: int = batch_rows
+        self.batch_delay: float = batch_delay
+
+        self.events: EventQueue = EventQueue()
+        self.extracted: Queue = Queue(queue_size)
+        self.encrypted: Queue = Queue(queue_size)
+
+        for stage in ("extract", "crypto", "write"):
+            self.stats[stage] = {"items": 0, "seconds": 0.0}
+        self.stats["events"] = {"received": 0, "coalesced": 0}
+        self.stats["extractors"] = index.extraction_stats
+
+        self.extract_threads = [
+            threading.Thread(target=self.extract, name=f"extract-{i}", daemon=True)
+            for i in range(extract_workers)
+        ]
+        self.crypto_threads = [
+            threading.Thread(target=self.encrypt, name=f"crypto-{i}", daemon=True)
+            for i in range(crypto_workers)
+        ]
+        self.write_thread = threading.Thread(
+            target=self.write, name="write", daemon=True
+        )
+        self.merger: AutoMerge = AutoMerge(
+            scheme,
+            stats,
+            self.stats_lock,
+            merge_rows,
+            merge_words,
+            merge_delay,
+            merge_interval,
+        )
+
+    def start(self) -> None:
+        for thread in [*self.extract_threads, *self.crypto_threads, self.write_thread]:
+            thread.start()
+        self.merger.start()
+
+    def put(self, client_path: Path, event_type: str) -> None:
+        """Ajoute un événement (bloque si la file est pleine)."""
+        self.events.put(client_path, event_type)
+        with self.stats_lock:
+            self.stats["events"]["received"] = self.events.received
+            self.stats["events"]["coalesced"] = self.events.coalesced
+
+    def close(self) -> None:
+        """Traite les événements en attente, puis arrête les threads."""
+        self.events.close()
+        for thread in self.extract_threads:
+            thread.join()
+        for _ in self.crypto_threads:
+            self.extracted.put(STOP)
+        for thread in self.crypto_threads:
+            thread.join()
+        self.encrypted.put(STOP)
+        self.write_thread.join()
+        self.merger.close()
+        console.log(self.summary())
+
+    def count(self, stage: str, items: int, seconds: float) -> None:
+        with self.stats_lock:
+            self.stats[stage]["items"] += items
+            self.stats[stage]["seconds"] += seconds
+
+    def extract(self) -> None:
+        while (event := self.events.get()) is not None:
+            client_path, event_type = event
+            if event_type == "deleted":
+                # L'ajout précédent du fichier est déjà dans la file d'écriture
+                self.encrypted.put(("delete", client_path))
+                self.events.done(client_path)
+                continue
+            start = monotonic()
+            try:
+                words = index.index_file(client_path)
+            except Exception as e:
+                console.error(f"Failed to index '{client_path}': {e}")
+                self.events.done(client_path)
+                continue
+            duration = monotonic() - start
+            self.count("extract", 1, duration)
+            with self.stats_lock:
+                self.stats["index"] += duration
+            self.extracted.put((client_path, words))
+
+    def encrypt(self) -> None:
+        while (item := self.extracted.get()) is not STOP:
+            client_path, words = item
+            start = monotonic()
+            try:
+                crypt.encrypt_file(client_path, self.scheme.key)
+                rows = self.scheme.prepare_file_words(client_path, words)
+            except Exception as e:
+                console.error(f"Failed to encrypt '{client_path}': {e}")
+            else:
+                duration = monotonic() - start
+                self.count("crypto", 1, duration)
+                with self.stats_lock:
+                    self.stats["encrypt"] += duration
+                self.encrypted.put(("add", len(words), rows))
+            finally:
+                self.events.done(client_path)
+
+    def write(self) -> None:
+        rows: dict[str, list[tuple[bytes, bytes]]] = {}
+        deleted: list[Path] = []
+        files, words, size = 0, 0, 0
+        deadline = 0.0
+        while True:
+            pending = files or deleted
+            timeout = max(0.0, deadline - monotonic()) if pending else None
+            try:
+                item = self.encrypted.get(timeout=timeout)
+            except Empty:
+                item = None
+            if item is not None and item is not STOP:
+                if not pending:
+                    deadline = monotonic() + self.batch_delay
+                if item[0] == "delete":
+                    deleted.append(item[1])
+                else:
+                    _, count, file_rows = item
+                    for table_name, table_rows in file_rows.items():
+                        rows.setdefault(table_name, []).extend(table_rows)
+                        size += len(table_rows)
+                    files += 1
+                    words += count
+                if size + len(deleted) < self.batch_rows:
+                    continue
+            if files or deleted:
+                self.flush(rows, files, words, deleted)
+                rows, deleted, files, words, size = {}, [], 0, 0, 0
+            if item is STOP:
+                return
+
+    def flush(
+        self,
+        rows: dict[str, list[tuple[bytes, bytes]]],
+        files: int,
+        words: int,
+        deleted: list[Path],
+    ) -> None:
+        """Écrit les entrées du lot, puis retire ses fichiers supprimés."""
+        start = monotonic()
+        try:
+            if files:
+                self.scheme.write_entries(rows)
+            if deleted:
+                self.scheme.remove_files(deleted)
+        except Exception as e:
+            console.error(
+                f"Failed to write a batch of {files} added and "
+                f"{len(deleted)} deleted files: {e}"
+            )
+            return
+        self.count("write", files + len(deleted), monotonic() - start)
+        with self.stats_lock:
+            verbose = self.stats["files"] // 100 != (self.stats["files"] + files) // 100
+            self.stats["files"] += files
+            self.stats["removed"] += len(deleted)
+            self.stats["words"] += words
+        console.log(self.summary(), verbose=verbose)
+
+    def summary(self) -> str:
+        with self.stats_lock:
+            stats = self.stats
+            stages = ", ".join(
+                f"{stage}: {stats[stage]['items'] / stats[stage]['seconds']:.1f}/s"
+                for stage in ("extract", "crypto", "write")
+                if stats[stage]["seconds"]
+            )
+            with index.stats_lock:
+                extractors = ", ".join(
+                    f"{name}: {extractor['files'] / extractor['seconds']:.1f}/s"
+                    for name, extractor in stats["extractors"].items()
+                    if extractor["seconds"]
+                )
+            return (
+                "STATS : "
+                f"Added {stats['files']} files, "
+                f"Removed {stats['removed']} files, "
+                f"Indexed {stats['words']} words, "
+                f"Events: {stats['events']['received']} "
+                f"({stats['events']['coalesced']} coalesced), "
+                f"Pending: {len(self.events)}, "
+                f"Throughput: {stages or '-'}, "
+                f"Merging: {stats['merge']:.2f} seconds, "
+                f"Extractors: {extractors or '-'}. "
+                f"{index.stem_cache.stats()}"
+            )
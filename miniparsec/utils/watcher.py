@@ -7,6 +7,7 @@ from watchdog.observers import Observer
 
 from miniparsec.schemes import Scheme
 from miniparsec.utils import console, file
+from miniparsec.utils.pipeline import IngestPipeline
 
 
 class Watcher:
@@ -22,23 +23,40 @@ class Watcher:
         try:
             while True:
                 time.sleep(1)
+        except KeyboardInterrupt:
+            self.observer.stop()
         except Exception as e:
             self.observer.stop()
             console.error(f"Watcher raised exception '{e}'.")
         self.observer.join()
+        self.handler.close()
         console.log("Watcher Terminated.")
 
 
 class MyHandler(FileSystemEventHandler):
-    def __init__(self, scheme: Scheme) -> None:
+    """Reçoit les événements du watcher et les confie à la chaîne d'ingestion.
+
+    Le thread de l'observateur ne fait qu'ajouter les événements à la file :
+    l'extraction, le chiffrement et l'écriture se font dans les threads de
+    `IngestPipeline`.
+    """
+
+    def __init__(self, scheme: Scheme, **options) -> None:
         self.scheme: Scheme = scheme
         self.stats: dict = {
             "files": 0,
+            "removed": 0,
             "words": 0,
             "encrypt": 0.0,
             "index": 0.0,
             "merge": 0.0,
         }
+        self.pipeline: IngestPipeline = IngestPipeline(scheme, self.stats, **options)
+        self.pipeline.start()
+
+    def is_ignored(self, client_path: Path) -> bool:
+        # Copies déchiffrées temporairement par `Scheme.remove_file`
+        return client_path.name[:5] == "temp_"
 
     def on_any_event(self, event):
         client_path = Path(event.src_path)
@@ -51,51 +69,13 @@ class MyHandler(FileSystemEventHandler):
                         os.mkdir(server_path)
                     except FileExistsError:
                         pass
-                else:
-                    basename = client_path.name
-                    is_tempfile = basename[:5] == "temp_"
-                    is_protected = basename in self.scheme.protected_filenames
-                    if not is_protected and not is_tempfile:
-                        verbose = True
-                        verbose = self.stats["files"] % 100 == 99
-                        console.log(
-                            f"File '{client_path}' added by user.", verbose=verbose
-                        )
-                        try:
-                            t1, t2, count = self.scheme.add_file(
-                                client_path, verbose=verbose
-                            )
-                        except UnicodeDecodeError:
-                            console.error(f"Failed to decode file {client_path}")
-                        else:
-                            console.log(
-                                f"Encryption: {t1:.2f}s, indexing {count} words: {t2:.2f}s",
-                                verbose=verbose,
-                            )
-                            self.stats["files"] = self.stats["files"] + 1
-                            self.stats["words"] = self.stats["words"] + count
-                            self.stats["encrypt"] = self.stats["encrypt"] + t1
-                            self.stats["index"] = self.stats["index"] + t2
-
-                            # if self.stats["files"] % 1000 == 0:
-                            #     t = timing.timing(self.scheme.merge)()
-                            #     self.stats["merge"] += t
-
-                            console.log(
-                                "STATS : "
-                                f"Added {self.stats['files']} files, "
-                                f"Indexed {self.stats['words']} words, "
-                                f"Encryption: {self.stats['encrypt']:.2f} seconds, "
-                                f"Indexing: {self.stats['index']:.2f} seconds, "
-                                f"Merging: {self.stats['merge']:.2f} seconds.\n",
-                                verbose=verbose,
-                            )
+                elif not self.is_ignored(client_path):
+                    self.pipeline.put(client_path, "created")
 
             case "deleted":
-                file_path = event.src_path
-                console.log(f"File '{file_path}' deleted by user.")
-                basename = client_path.name
-                is_tempfile = basename[:5] == "temp_"
-                is_protected = basename in self.scheme.protected_filenames
-                if not is_protected and not is_tempfile:
-                    _ = self.scheme.remove_file(file_path)
+                console.log(f"File '{client_path}' deleted by user.")
+                if not self.is_ignored(client_path):
+                    self.pipeline.put(client_path, "deleted")
+
+    def close(self) -> None:
+        self.pipeline.close()
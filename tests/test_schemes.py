@@ -0,0 +1,155 @@
+"""Ajout, fusion, recherche et révocation des schémas, sans base de données."""
+
+import asyncio
+import random
+from collections.abc import Callable
+from pathlib import Path
+
+import pytest
+
+from miniparsec import schemes
+from miniparsec.crypt import hmac
+from miniparsec.paths import CLIENT_ROOT, SERVER_ROOT
+from miniparsec.storage import MemoryStorage, SQLiteStorage, Storage
+
+KEY = hmac("test")[:32]
+
+VOCABULARY = ["alpha", "beta", "gamma"] + [
+    f"w{a}{b}" for a in "abcdefgh" for b in "abcdefgh"
+]
+
+STORAGES: dict[str, Callable[[], Storage]] = {
+    "memory": MemoryStorage,
+    "sqlite": SQLiteStorage,
+}
+
+SCHEMES: dict[str, Callable[[Storage], schemes.Scheme]] = {
+    "pipackplus": lambda storage: schemes.PiPackPlus(KEY, storage, 3),
+    "pibasdyn": lambda storage: schemes.PiBasDyn(KEY, storage, 2),
+    "sophos": lambda storage: schemes.Sophos(KEY, storage),
+    "diana": lambda storage: schemes.Diana(KEY, storage),
+}
+
+
+@pytest.fixture(autouse=True)
+def data(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Dossiers client et serveur (et base SQLite) dans un dossier temporaire."""
+    monkeypatch.chdir(tmp_path)
+    CLIENT_ROOT.mkdir(parents=True)
+    SERVER_ROOT.mkdir(parents=True)
+
+
+def add_files(
+    scheme: schemes.Scheme, truth: dict[str, set[str]], start: int, count: int
+) -> list[Path]:
+    """Ajoute `count` fichiers aléatoires, et note leurs mots dans `truth`."""
+    rng = random.Random(start)
+    paths = []
+    for i in range(start, start + count):
+        words = rng.sample(VOCABULARY, 12) + (["alpha"] if i % 2 else [])
+        path = CLIENT_ROOT / f"f{i}.txt"
+        path.write_text(" ".join(words))
+        paths.append(path)
+        for word in words:
+            truth.setdefault(word, set()).add(path.name)
+    scheme.add_files_words(paths, verbose=False)
+    return paths
+
+
+def check(scheme: schemes.Scheme, truth: dict[str, set[str]]) -> None:
+    for word in ["alpha", "beta", "gamma", "waa", "zzz"]:
+        assert scheme.resolve(scheme.search_word(word)) == truth.get(word, set())
+    words = ["alpha", "beta"]
+    both = truth["alpha"] & truth["beta"]
+    assert scheme.resolve(scheme.search_intersection(words)) == both
+    either = truth["alpha"] | truth["beta"]
+    assert scheme.resolve(scheme.search_union(words)) == either
+
+
+@pytest.mark.parametrize("storage_name", STORAGES)
+@pytest.mark.parametrize("scheme_name", SCHEMES)
+def test_search(storage_name: str, scheme_name: str) -> None:
+    storage = STORAGES[storage_name]()
+    scheme = SCHEMES[scheme_name](storage)
+    scheme.reset()
+    truth: dict[str, set[str]] = {}
+
+    add_files(scheme, truth, 0, 20)
+    check(scheme, truth)
+    scheme.merge()
+    check(scheme, truth)
+    add_files(scheme, truth, 20, 10)
+    check(scheme, truth)
+    scheme.merge()
+    check(scheme, truth)
+    # L'état du client est relu depuis le disque
+    check(SCHEMES[scheme_name](storage), truth)
+
+
+@pytest.mark.parametrize("storage_name", STORAGES)
+def test_revocation(storage_name: str) -> None:
+    storage = STORAGES[storage_name]()
+    scheme = schemes.PiBasDyn(KEY, storage, 2)
+    scheme.reset()
+    truth: dict[str, set[str]] = {}
+
+    paths = add_files(scheme, truth, 0, 20)
+    scheme.merge()
+    removed = paths[::3]
+    scheme.remove_files(removed)
+    for documents in truth.values():
+        documents.difference_update(path.name for path in removed)
+    check(scheme, truth)
+    found = asyncio.run(scheme.search_word_async("alpha"))
+    assert scheme.resolve(found) == truth["alpha"]
+    scheme.merge()
+    check(scheme, truth)
+    assert not list(storage.scan("revoked"))
+
+
+def test_revocation_threshold() -> None:
+    """EDB n'est réécrite qu'une fois assez de documents révoqués."""
+    storage = MemoryStorage()
+    scheme = schemes.PiBasDyn(KEY, storage, 2)
+    scheme.reset()
+    truth: dict[str, set[str]] = {}
+
+    paths = add_files(scheme, truth, 0, 20)
+    scheme.merge()
+    for removed in ([paths[0]], paths[1:3]):
+        scheme.remove_files(removed)
+        for documents in truth.values():
+            documents.difference_update(path.name for path in removed)
+        scheme.merge()
+        check(scheme, truth)
+    assert not list(storage.scan("revoked"))
+
+    scheme.remove_files([paths[3]])
+    edb = sorted(storage.scan("edb"))
+    scheme.merge()
+    assert sorted(storage.scan("edb")) == edb
+    assert len(list(storage.scan("revoked"))) == 1
+
+
+@pytest.mark.parametrize("storage_name", STORAGES)
+def test_revocation_after_restart(storage_name: str) -> None:
+    """Un document révoqué dans la table tampon courante survit à un redémarrage."""
+    storage = STORAGES[storage_name]()
+    scheme = schemes.PiBasDyn(KEY, storage, 2)
+    scheme.reset()
+    truth: dict[str, set[str]] = {}
+
+    add_files(scheme, truth, 0, 10)
+    scheme.merge()
+    paths = add_files(scheme, truth, 10, 4)
+    scheme.remove_files(paths)
+    for documents in truth.values():
+        documents.difference_update(path.name for path in paths)
+    revoked = set(range(10, 14))
+
+    restarted = schemes.PiBasDyn(KEY, storage, 2)
+    for _ in range(2):
+        restarted.merge()
+        assert not restarted.search_word("alpha") & revoked
+        check(restarted, truth)
+    assert not list(storage.scan("revoked"))